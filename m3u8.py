@@ -1,46 +1,2842 @@
+import io
 import os
+import re
+import sys
+import json
+import stat
+import queue
+import time
+import errno
+import random
+import bisect
+import asyncio
+import hashlib
+import datetime
+import itertools
+import threading
+import http.server
+import urllib3
 import requests
-import m3u8
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, urljoin
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-# 创建保存TS文件的文件夹
+# 本脚本也叫 m3u8.py：直接运行时脚本所在目录排在 sys.path 最前面，import m3u8 会导入脚本自己而不是 m3u8 库；
+# 导入库时先把这个目录移出 sys.path，sys.modules 里占着这个名字的若是脚本自己也暂时让开
+_script_path = os.path.realpath(__file__)
+_sys_path = sys.path[:]
+_shadowing = sys.modules.get("m3u8")
+if _shadowing is not None and os.path.realpath(getattr(_shadowing, "__file__", None) or "") == _script_path:
+    del sys.modules["m3u8"]
+else:
+    _shadowing = None
+sys.path[:] = [p for p in sys.path if os.path.realpath(p or os.curdir) != os.path.dirname(_script_path)]
+try:
+    import m3u8  # 需安装: pip install m3u8
+finally:
+    sys.path[:] = _sys_path
+    if _shadowing is not None:
+        sys.modules["m3u8"] = _shadowing
+
+try:
+    import aiohttp  # 需安装: pip install aiohttp（未安装时自动退回线程池模式）
+except ImportError:
+    aiohttp = None
+
+try:
+    from Crypto.Cipher import AES  # 需安装: pip install pycryptodome（解密 EXT-X-KEY 加密的分片）
+except ImportError:
+    AES = None
+
+try:
+    import numpy as np  # 需安装: pip install numpy（向量化校验 TS 分片；未安装时只检查长度和同步字节）
+except ImportError:
+    np = None
+
+try:
+    import ts_remux  # 同目录下的 ts_remux.py：TS 转封装为分片 MP4（缺少时直接拼接 TS）
+except ImportError:
+    ts_remux = None
+
+# 保存TS文件的文件夹（仅 "files" 合并模式使用）
 output_folder = "ts_files"
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
-
-# 下载TS文件
-def download_ts_file(url, output_file):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(output_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-    print(f"Downloaded: {output_file}")
-
-# 下载并保存所有TS文件
-def download_all_ts_files(m3u8_file):
-    # 读取本地m3u8文件内容
-    m3u8_obj = m3u8.load(m3u8_file)
-    
-    # 多线程下载，并显示进度
-    with ThreadPoolExecutor(max_workers=10) as executor:
+
+# 下载引擎: "async"（asyncio + 长连接池）或 "thread"（线程池，作为后备）
+download_engine = "async"
+# 合并模式: "stream"（按顺序直接写入输出文件）、"files"（先落盘到 ts_files 再合并）
+# 或 "preallocate"（预先确定每个分片的大小，预分配输出文件，分片完成后直接写到自己的位置；
+# 分片大小无法预先确定时退回 "stream"）
+merge_mode = "stream"
+# "stream" 模式下最多缓存多少个已下载、但还没轮到写出的分片（决定内存上限）
+reorder_window = 32
+# 同时进行的分片下载数量上限（所有主机合计）
+max_workers = 64
+# 每个主机一开始的并发数；关闭自适应并发时就是固定的并发数
+initial_workers = 10
+# 是否按 AIMD 自动调整每个主机的并发数：吞吐量上升且延迟稳定时 +1，出错或被限流时减半
+adaptive_concurrency = True
+# 每个主机的最小并发数
+min_workers = 1
+# 每个主机最多保持的 keep-alive 连接数，也是该主机并发数的默认上限
+max_connections_per_host = 32
+# 单独指定某些主机的并发上限，例如 {"cdn.example.com": 4}
+host_limits = {}
+# 这些状态码表示源站在限流或过载，需要降低并发
+throttle_statuses = (429, 503)
+# 单次请求的连接/读取超时（秒）
+connect_timeout = 10
+request_timeout = 30
+# 每个分片失败后最多重试几次
+retry_attempts = 5
+# 重试等待：min(retry_max_delay, retry_base_delay * 2^n) 内随机取值（full jitter）
+retry_base_delay = 0.5
+retry_max_delay = 30
+# 可以重试的状态码，其余 4xx 直接判定失败
+retry_statuses = (408, 425, 429, 500, 502, 503, 504)
+# 对冲请求：分片耗时超过最近分片的 p95 时再发一个相同请求，先完成的为准
+hedge_requests = False
+# 计算 p95 用的最近分片数，以及开始对冲前至少需要的样本数
+hedge_sample_size = 100
+hedge_min_samples = 20
+# 镜像/多 CDN：同样的分片路径也可以从这些基础地址下载，例如 ["https://cdn2.example.com"]
+mirrors = []
+# 按主机改写，例如 {"cdn1.example.com": ["cdn2.example.com", "cdn3.example.com"]}
+host_rewrites = {}
+# 镜像连续失败多少次后暂时剔除，以及剔除多久（秒）
+mirror_eject_failures = 3
+mirror_eject_seconds = 60
+# 限速（字节/秒，None 表示不限）：整个进程、单个主机、单个下载任务三级令牌桶
+rate_limit = None
+host_rate_limits = {}
+job_rate_limit = None
+# 令牌桶最多攒下多少秒的额度，决定突发量
+rate_burst_seconds = 0.5
+# 限速等待时每隔多少秒醒来一次，检查限速是否被调整
+rate_limit_poll = 0.2
+# 运行中修改限速：JSON 文件，例如 {"global": 5000000, "hosts": {"cdn.example.com": 1000000}, "job": null}，
+# 修改后一秒内生效
+rate_limit_file = None
+# 指标：Prometheus 文本格式写入这个文件（None 表示不写），随进度行一起刷新
+metrics_file = None
+# 在本机这个端口提供 http://127.0.0.1:端口/metrics（None 表示不启用）
+metrics_port = None
+# 进度行最多每隔多少秒输出一次
+progress_interval = 2.0
+# 耗时直方图的分桶上界（秒）
+latency_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 批量模式的调度: "fair"（按优先级加权轮流分配下载名额）或 "priority"（优先级高的任务先下载）
+batch_policy = "fair"
+# 空闲长连接的保留时间（秒）
+keepalive_timeout = 30
+# 线程模式每次 readinto 最多读取的字节数（异步模式把收到的数据块原样拷进缓冲区）
+read_chunk_size = 1024 * 1024
+# 下载缓冲池最多保留多少字节的空闲缓冲区
+buffer_pool_size = 64 * 1024 * 1024
+# 合并时内核拷贝不可用时使用的缓冲区大小
+merge_buffer_size = 1024 * 1024
+# 输出转封装为分片 MP4: "auto"（输出文件名以 .mp4 结尾时）、True（总是）或 False（直接拼接 TS）
+remux_mp4 = "auto"
+# 是否校验下载的 TS 分片（包对齐、同步字节），校验失败的分片换镜像重新下载；连续计数器跳变只告警
+validate_segments = True
+# 同一文件里相邻的 EXT-X-BYTERANGE 分片合并成一个 Range 请求，每个请求最多合并这么多字节（0 表示不合并）
+coalesce_max_bytes = 8 * 1024 * 1024
+# 是否断点续传（在输出文件旁写入 .journal 记录已完成的分片）
+resume_downloads = True
+# 转封装输出（.mp4）是否也断点续传。默认边下载边转封装，不产生临时文件，但输出和分片不再一一对应，中断后要重新下载；
+# 设为 True 时先按顺序写成 "输出文件.ts" 并记日志（可以续传），全部完成后再转封装一遍并删除，多占一份磁盘空间。
+# 单个任务和批量任务都按这个设置处理
+resume_remux = False
+# 分片缓存目录（None 表示不启用）：按地址索引、按内容去重保存下载的分片，批量任务和多次运行共用，命中时不发请求
+segment_cache_dir = None
+# 分片缓存的容量上限（字节），超出时淘汰最久没用过的内容
+segment_cache_size = 4 * 1024 ** 3
+# 缓存的分片多久之内直接使用（秒）；过期后带 ETag/Last-Modified 向源站确认，None 表示一直有效
+segment_cache_ttl = None
+# 解密用的执行器: "thread"（线程池）或 "process"（进程池，多核并行解密）
+decrypt_executor = "thread"
+# 解密池的大小
+decrypt_workers = os.cpu_count() or 4
+# 媒体播放列表的解析方式: "lean"（逐行解析成精简的分片记录，边解析边下载；遇到不认识的标签时改用 m3u8 库）
+# 或 "m3u8"（始终用 m3u8 库构建完整的对象）
+playlist_parser = "lean"
+# 直播/EVENT 播放列表是否持续刷新跟随，直到出现 EXT-X-ENDLIST
+follow_live = False
+# 主播放列表的码率选择: "best"（最高）、"worst"（最低）或 "adaptive"（按实测吞吐量在分片边界切换）
+variant_policy = "best"
+# 选择码率时的上限（None 表示不限制）
+max_bandwidth = None
+max_height = None
+# adaptive 模式要求在多少秒内下载完；None 表示至少跟上播放速度
+adaptive_deadline = None
+# adaptive 模式只使用实测吞吐量的这一比例，留出余量
+adaptive_safety = 0.8
+# 广告/垫片过滤规则，依次检查，任一规则命中的分片在发出请求之前就跳过：
+#   "cue"                   EXT-X-CUE-OUT 到 EXT-X-CUE-IN（或 CUE-OUT 声明的时长结束）之间的分片
+#   ("uri", 正则)            URI 匹配正则的分片，例如 ("uri", r"/ads?/")
+#   ("duration", 秒数, ...)  总时长等于其中之一的整个不连续段（两个 EXT-X-DISCONTINUITY 之间的分片）
+#   函数 rule(segment, context)，context.block/duration 是分片所在的不连续段及其总时长，context.in_cue 表示处在插播时段内，
+#   返回 True 表示跳过
+ad_filters = ()
+# 按时长识别广告段时允许的误差（秒）
+ad_duration_tolerance = 0.25
+# 只下载这一时间段（按分片边界取整，包含起止时刻所在的分片）；None 表示不限。
+# 可以是秒数、"HH:MM:SS"（从播放列表开头算起），或 datetime / ISO 8601 时间（按 EXT-X-PROGRAM-DATE-TIME 定位）
+clip_start = None
+clip_end = None
+
+# 线程模式共用的 Session，避免每个分片都重新握手
+_session = None
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections_per_host,
+                              pool_maxsize=max_connections_per_host)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+# 一个待下载的分片：序号、地址、续传用的已有内容，以及 AES-128 的 key/iv（未加密时为 None）；
+# 下载完成后引擎会填上 size（字节数）和 elapsed（耗时，秒）；limiter 是所属下载任务的限速器，
+# job 是批量模式中分片所属的 DownloadJob（单个下载时为 None）；
+# byterange 是 EXT-X-BYTERANGE 分片在文件中的 (偏移, 长度)，合并了相邻分片时 parts 按顺序记录
+# 每个分片的 (序号, 长度, key, iv)；init 是 EXT-X-MAP 切换时要写在第一个分片前面的初始化分片
+class SegmentTask:
+    __slots__ = ("index", "url", "partial", "key", "iv", "size", "elapsed", "limiter", "job", "byterange", "parts",
+                 "init")
+
+    def __init__(self, index, url, partial=b"", key=None, iv=None, byterange=None):
+        self.index = index
+        self.url = url
+        self.partial = partial
+        self.key = key
+        self.iv = iv
+        self.size = None
+        self.elapsed = None
+        self.limiter = None
+        self.job = None
+        self.byterange = byterange
+        self.parts = None
+        self.init = None
+
+    # 本任务包含的分片数
+    @property
+    def count(self):
+        return len(self.parts) if self.parts else 1
+
+    # 本任务包含的分片序号
+    @property
+    def indices(self):
+        return [part[0] for part in self.parts] if self.parts else [self.index]
+
+    # 紧接在本任务字节范围之后的分片并入本任务
+    def merge(self, index, byterange, key, iv):
+        if self.parts is None:
+            self.parts = [(self.index, self.byterange[1], self.key, self.iv)]
+        self.parts.append((index, byterange[1], key, iv))
+        self.byterange = (self.byterange[0], self.byterange[1] + byterange[1])
+
+# AIMD 并发控制器，每个主机一个：每完成 level 个分片算一轮，
+# 本轮吞吐量比上一轮高且延迟中位数不超过历史最好值的两倍时并发 +1；
+# 遇到连接错误、5xx 或限流状态码时并发减半，同一段拥塞只减一次
+class ConcurrencyController:
+    def __init__(self, host, maximum):
+        self.host = host
+        self.maximum = maximum
+        self.level = max(min_workers, min(initial_workers, maximum))
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.best_latency = None
+        self.last_throughput = 0
+        self.cooldown_until = 0
+        self.recent_latencies = deque(maxlen=hedge_sample_size)
+        self._new_round(time.monotonic())
+
+    def _new_round(self, now):
+        self.round_started = now
+        self.round_bytes = 0
+        self.round_latencies = []
+
+    def _set_level(self, level, reason):
+        if level != self.level:
+            print(f"并发调整 {self.host}: {self.level} -> {level}（{reason}）")
+            self.level = level
+
+    # 最近成功分片耗时的 p95，样本不足时返回 None
+    def p95(self):
+        latencies = sorted(self.recent_latencies)
+        if len(latencies) < hedge_min_samples:
+            return None
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    # status 为 None 表示连接出错
+    def record(self, nbytes, elapsed, status):
+        overloaded = status is None or status >= 500 or status in throttle_statuses
+        if not overloaded and status >= 400:
+            return  # 404 之类的错误与源站负载无关
+        if not overloaded:
+            self.recent_latencies.append(elapsed)
+        if not adaptive_concurrency:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if overloaded:
+                if now >= self.cooldown_until:
+                    self._set_level(max(min_workers, self.level // 2), f"状态 {status or '连接错误'}")
+                    self.cooldown_until = now + max(elapsed, 1.0)
+                    self.last_throughput = 0
+                    self._new_round(now)
+                return
+
+            self.round_bytes += nbytes
+            self.round_latencies.append(elapsed)
+            if len(self.round_latencies) < self.level:
+                return
+            throughput = self.round_bytes / max(now - self.round_started, 1e-6)
+            latency = sorted(self.round_latencies)[len(self.round_latencies) // 2]
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+            if throughput > self.last_throughput * 1.05 and latency <= self.best_latency * 2:
+                self._set_level(min(self.maximum, self.level + 1), f"{throughput / 1e6:.1f} MB/s")
+            self.last_throughput = throughput
+            self._new_round(now)
+
+controllers = {}
+_controllers_lock = threading.Lock()
+
+def host_of(url):
+    return urlsplit(url).netloc
+
+def get_controller(host):
+    with _controllers_lock:
+        if host not in controllers:
+            controllers[host] = ConcurrencyController(host, host_limits.get(host, max_connections_per_host))
+        return controllers[host]
+
+# 当前每个主机的并发数
+def concurrency_levels():
+    return {host: controller.level for host, controller in controllers.items()}
+
+# 一个镜像主机的统计：吞吐量和错误率都是指数滑动平均
+class MirrorStats:
+    __slots__ = ("throughput", "error_rate", "failures", "ejected_until")
+
+    def __init__(self):
+        self.throughput = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.ejected_until = 0
+
+# 把分片请求分散到多个镜像：按实测吞吐量和错误率加权随机选择，连续失败的镜像暂时剔除
+class MirrorPool:
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    # 同一个分片在所有镜像上的地址，第一个是原地址
+    def candidates(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        bases = [origin] + [mirror.rstrip("/") for mirror in mirrors]
+        bases += [f"{parts.scheme}://{host}" for host in host_rewrites.get(parts.netloc, ())]
+        return [base + url[len(origin):] for base in dict.fromkeys(bases)]
+
+    def _stats(self, host):
+        if host not in self.stats:
+            self.stats[host] = MirrorStats()
+        return self.stats[host]
+
+    # 选一个镜像地址；avoid 为刚失败的主机，重试时尽量换一个
+    def pick(self, url, avoid=None):
+        candidates = self.candidates(url)
+        if len(candidates) == 1:
+            return url
+        now = time.monotonic()
+        with self.lock:
+            others = [c for c in candidates if host_of(c) != avoid] or candidates
+            usable = [c for c in others if self._stats(host_of(c)).ejected_until <= now] or others
+            known = [self._stats(host_of(c)).throughput for c in usable]
+            known = [t for t in known if t]
+            # 还没有数据的镜像按已知镜像的平均值对待，保证它能被试到
+            default = sum(known) / len(known) if known else 1.0
+            weights = []
+            for candidate in usable:
+                stats = self._stats(host_of(candidate))
+                weights.append((stats.throughput or default) * (1 - stats.error_rate) ** 2 + 1e-9)
+        return random.choices(usable, weights)[0]
+
+    def record(self, url, nbytes, elapsed, ok):
+        if not (mirrors or host_rewrites):
+            return
+        host = host_of(url)
+        with self.lock:
+            stats = self._stats(host)
+            stats.error_rate = stats.error_rate * 0.8 + (0.0 if ok else 0.2)
+            if ok:
+                stats.failures = 0
+                rate = nbytes / max(elapsed, 1e-6)
+                stats.throughput = rate if stats.throughput is None else stats.throughput * 0.8 + rate * 0.2
+                return
+            stats.failures += 1
+            if stats.failures >= mirror_eject_failures and stats.ejected_until <= time.monotonic():
+                stats.ejected_until = time.monotonic() + mirror_eject_seconds
+                print(f"镜像 {host} 连续失败 {stats.failures} 次，暂时剔除 {mirror_eject_seconds} 秒")
+
+mirror_pool = MirrorPool()
+
+# 令牌桶：额度可以透支，reserve 返回调用方需要等待的秒数，等待由调用方自己完成（线程 sleep 或 asyncio.sleep）
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.version = 0  # 每次调整限速加一，正在等待的读取据此提前结束
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate or None
+            self.burst = (rate or 0) * rate_burst_seconds
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+            self.version += 1
+
+    def reserve(self, nbytes):
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - nbytes
+            self.updated = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+# 令牌桶在第一次使用时按配置创建，之后用 set_rate_limit 或限速配置文件调整
+global_bucket = None
+host_buckets = {}
+_rate_file_state = {"checked": 0, "mtime": None}
+
+def get_global_bucket():
+    global global_bucket
+    if global_bucket is None:
+        global_bucket = TokenBucket(rate_limit)
+    return global_bucket
+
+def get_host_bucket(host):
+    if host not in host_buckets:
+        host_buckets.setdefault(host, TokenBucket(host_rate_limits.get(host)))
+    return host_buckets[host]
+
+# 运行中调整限速；host 为 None 时调整整个进程的限速
+def set_rate_limit(rate, host=None):
+    if host is None:
+        get_global_bucket().set_rate(rate)
+    else:
+        host_rate_limits[host] = rate
+        get_host_bucket(host).set_rate(rate)
+    print(f"限速调整 {host or '全局'}: {f'{rate / 1e6:.2f} MB/s' if rate else '不限'}")
+
+# 每个下载任务一个限速器，读数据时同时从进程、主机、任务三个令牌桶扣额度
+class RateLimiter:
+    def __init__(self, rate=None):
+        self.job_bucket = TokenBucket(rate)
+
+    # 读到 nbytes 字节后扣额度，返回 (等到什么时候, [(令牌桶, 扣额度时的版本)])
+    def reserve(self, host, nbytes):
+        reload_rate_limit_file()
+        buckets = (get_global_bucket(), get_host_bucket(host), self.job_bucket)
+        delay = max(bucket.reserve(nbytes) for bucket in buckets)
+        return time.monotonic() + delay, [(bucket, bucket.version) for bucket in buckets]
+
+    # 还要等多少秒；等待期间限速被调整过就不再等，新的限速从下一次读取开始生效
+    @staticmethod
+    def remaining(plan):
+        deadline, versions = plan
+        if any(bucket.version != version for bucket, version in versions):
+            return 0
+        return deadline - time.monotonic()
+
+    # 读到 nbytes 字节后按限速等待：分段睡眠，每段之间检查限速配置文件，调整限速对正在等待的读取也及时生效
+    def wait(self, host, nbytes):
+        plan = self.reserve(host, nbytes)
+        while (remaining := self.remaining(plan)) > 0:
+            time.sleep(min(remaining, rate_limit_poll))
+            reload_rate_limit_file()
+
+    async def wait_async(self, host, nbytes):
+        plan = self.reserve(host, nbytes)
+        while (remaining := self.remaining(plan)) > 0:
+            await asyncio.sleep(min(remaining, rate_limit_poll))
+            reload_rate_limit_file()
+
+# 限速配置文件有变化时重新加载，最多每秒检查一次
+def reload_rate_limit_file():
+    global job_rate_limit
+    if not rate_limit_file:
+        return
+    now = time.monotonic()
+    if now - _rate_file_state["checked"] < 1:
+        return
+    _rate_file_state["checked"] = now
+    try:
+        mtime = os.path.getmtime(rate_limit_file)
+        if mtime == _rate_file_state["mtime"]:
+            return
+        with open(rate_limit_file) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取限速配置失败: {e}")
+        return
+    _rate_file_state["mtime"] = mtime
+    if "global" in config:
+        set_rate_limit(config["global"])
+    for host, rate in config.get("hosts", {}).items():
+        set_rate_limit(rate, host)
+    if "job" in config:
+        job_rate_limit = config["job"]
+        for limiter in list(_job_limiters):
+            limiter.job_bucket.set_rate(job_rate_limit)
+
+# 正在运行的下载任务的限速器，配置文件修改单任务限速时一起更新
+_job_limiters = set()
+
+# 直方图：按 latency_buckets 分桶计数，另记总和与次数
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(latency_buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.count += other.count
+
+    # 按分桶上界估计分位数
+    def quantile(self, q):
+        seen = 0
+        for bound, n in zip(latency_buckets + (float("inf"),), self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+        return 0
+
+# 指标名 -> (类型, 说明)
+metric_types = {
+    "segments_total": ("counter", "下载完成的分片数"),
+    "bytes_total": ("counter", "下载的字节数"),
+    "responses_total": ("counter", "按状态码统计的响应数"),
+    "retries_total": ("counter", "重试次数，reason 为状态码、invalid（校验失败）或 error（连接错误）"),
+    "failures_total": ("counter", "重试用尽或不可重试而放弃的请求数"),
+    "continuity_errors_total": ("counter", "TS 连续计数器跳变次数（只告警，不重试）"),
+    "segment_seconds": ("histogram", "每个请求从发出到下载完的耗时"),
+    "write_seconds": ("histogram", "每个分片写入输出的耗时（与网络耗时分开，用来区分 CDN 慢还是磁盘慢）"),
+    "written_bytes_total": ("counter", "写入输出的字节数"),
+    "cache_hits_total": ("counter", "直接从分片缓存取用、没有发请求的分片数"),
+    "cache_bytes_total": ("counter", "从分片缓存取用的字节数"),
+    "concurrency": ("gauge", "每个主机当前的并发数"),
+}
+
+# 标签值里的反斜杠、引号和换行需要转义
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+# 下载指标：按主机和任务（输出文件）汇总的计数器和耗时直方图，
+# 可导出为 Prometheus 文本格式；写入分片时顺带输出限频的进度行
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.default_job = ""  # 单个下载时的任务名（输出文件）
+        self.counters = {}  # (指标名, 标签) -> 值
+        self.histograms = {}  # (指标名, 标签) -> Histogram
+        self.start()
+
+    # 开始一次运行：进度行从零开始计数，导出的计数器和直方图继续累计
+    def start(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.expected = 0
+            self.written = 0
+            self.written_bytes = 0
+            self.retries = 0
+            self.last_progress = 0
+
+    def job_name(self, task):
+        return task.job.output_file if task.job else self.default_job
+
+    def _add(self, name, labels, value=1):
+        self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def _observe(self, name, labels, value):
+        if (name, labels) not in self.histograms:
+            self.histograms[name, labels] = Histogram()
+        self.histograms[name, labels].observe(value)
+
+    def expect(self, count):
+        with self.lock:
+            self.expected += count
+
+    # 一次成功的请求（合并请求的任务算 task.count 个分片）
+    def record_request(self, task, url, status, nbytes, elapsed):
+        host, job = host_of(url), self.job_name(task)
+        with self.lock:
+            self._add("responses_total", (("host", host), ("status", status)))
+            self._add("segments_total", (("host", host), ("job", job)), task.count)
+            self._add("bytes_total", (("host", host), ("job", job)), nbytes)
+            self._observe("segment_seconds", (("host", host), ("job", job)), elapsed)
+
+    # 一次失败的尝试；retried 为 False 表示重试已用尽或不可重试
+    def record_failure(self, task, url, error, retried):
+        host, job = host_of(url), self.job_name(task)
+        reason = error.status or ("invalid" if isinstance(error, InvalidSegment) else "error")
+        with self.lock:
+            if error.status:
+                self._add("responses_total", (("host", host), ("status", error.status)))
+            if retried:
+                self.retries += 1
+                self._add("retries_total", (("host", host), ("job", job), ("reason", reason)))
+            else:
+                self._add("failures_total", (("host", host), ("job", job), ("reason", reason)))
+
+    # 分片里的连续计数器跳变
+    def record_continuity(self, task, url, gaps):
+        host, job = host_of(url), self.job_name(task)
+        with self.lock:
+            self._add("continuity_errors_total", (("host", host), ("job", job)), gaps)
+
+    # 分片缓存命中，没有发出请求
+    def record_cache_hit(self, task, nbytes):
+        job = self.job_name(task)
+        with self.lock:
+            self._add("cache_hits_total", (("job", job),), task.count)
+            self._add("cache_bytes_total", (("job", job),), nbytes)
+
+    def record_write(self, job, nbytes, elapsed):
+        with self.lock:
+            self._observe("write_seconds", (("job", job),), elapsed)
+            self._add("written_bytes_total", (("job", job),), nbytes)
+            self.written += 1
+            self.written_bytes += nbytes
+        self.progress()
+
+    # 进度行：最多每 progress_interval 秒一行，final 时总是输出
+    def progress(self, final=False):
+        now = time.monotonic()
+        with self.lock:
+            if not final and now - self.last_progress < progress_interval:
+                return
+            self.last_progress = now
+            written, size, expected, retries = self.written, self.written_bytes, self.expected, self.retries
+        elapsed = max(now - self.started, 1e-6)
+        print(f"进度: {written}{f'/{expected}' if expected else ''} 个分片，{size / 1e6:.1f} MB，"
+              f"{size / elapsed / 1e6:.1f} MB/s，重试 {retries} 次")
+        if metrics_file:
+            self.write_file(metrics_file)
+
+    # Prometheus 文本格式
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            histograms = []
+            for key in sorted(self.histograms, key=str):
+                histogram = Histogram()
+                histogram.merge(self.histograms[key])
+                histograms.append((key, histogram))
+        samples = {}
+        for (name, labels), value in counters:
+            samples.setdefault(name, []).append(f"m3u8_{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(latency_buckets + ("+Inf",), histogram.counts):
+                cumulative += n
+                lines.append(f"m3u8_{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"m3u8_{name}_sum{_format_labels(labels)} {histogram.total:.6f}")
+            lines.append(f"m3u8_{name}_count{_format_labels(labels)} {histogram.count}")
+        samples["concurrency"] = [f"m3u8_concurrency{_format_labels((('host', host),))} {level}"
+                                  for host, level in sorted(concurrency_levels().items())]
+        output = []
+        for name, (kind, help_text) in metric_types.items():
+            if samples.get(name):
+                output.append(f"# HELP m3u8_{name} {help_text}")
+                output.append(f"# TYPE m3u8_{name} {kind}")
+                output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+    # 先写临时文件再替换，抓取方不会读到写了一半的内容
+    def write_file(self, path):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    # 运行结束时的汇总：每个主机的分片数、流量、耗时分位数、重试和状态码，以及写入耗时
+    def summary(self):
+        hosts = {}
+        writes = Histogram()
+        cached = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                labels = dict(labels)
+                if name.startswith("cache_"):
+                    cached[name] = cached.get(name, 0) + value
+                if "host" not in labels:
+                    continue
+                stats = hosts.setdefault(labels["host"], {"statuses": {}, "latency": Histogram()})
+                if name == "responses_total":
+                    stats["statuses"][labels["status"]] = stats["statuses"].get(labels["status"], 0) + value
+                else:
+                    stats[name] = stats.get(name, 0) + value
+            for (name, labels), histogram in self.histograms.items():
+                if name == "segment_seconds":
+                    hosts[dict(labels)["host"]]["latency"].merge(histogram)
+                else:
+                    writes.merge(histogram)
+        print(f"下载统计（{time.monotonic() - self.started:.1f} 秒）:")
+        for host, stats in sorted(hosts.items()):
+            latency = stats["latency"]
+            statuses = "，".join(f"{status}×{n}" for status, n in sorted(stats["statuses"].items(), key=str))
+            print(f"  {host}: {stats.get('segments_total', 0)} 个分片，{stats.get('bytes_total', 0) / 1e6:.1f} MB，"
+                  f"耗时 p50≤{latency.quantile(0.5)} 秒 p95≤{latency.quantile(0.95)} 秒，"
+                  f"重试 {stats.get('retries_total', 0)} 次，放弃 {stats.get('failures_total', 0)} 次"
+                  + (f"，状态码 {statuses}" if statuses else ""))
+        if cached:
+            print(f"  分片缓存: 命中 {cached.get('cache_hits_total', 0)} 个分片，"
+                  f"{cached.get('cache_bytes_total', 0) / 1e6:.1f} MB")
+        if writes.count:
+            print(f"  写入: {writes.count} 次，共 {writes.total:.2f} 秒，p95≤{writes.quantile(0.95)} 秒")
+
+metrics = Metrics()
+_metrics_server = None
+
+# 在本机端口上提供 /metrics 供 Prometheus 抓取（只启动一次）
+def start_metrics_server(port=None):
+    global _metrics_server
+    port = port or metrics_port
+    if not port or _metrics_server is not None:
+        return _metrics_server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    _metrics_server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    print(f"指标地址: http://127.0.0.1:{port}/metrics")
+    return _metrics_server
+
+# 运行结束：输出最后一行进度和汇总，刷新指标文件
+def report_metrics():
+    metrics.progress(final=True)
+    metrics.summary()
+
+# 播放列表里的相对地址按播放列表所在位置补全
+def absolute_uri(obj):
+    return obj.absolute_uri if obj.base_uri else obj.uri
+
+# 按 URI 缓存 EXT-X-KEY 的密钥，同一个 key 只下载一次
+class KeyCache:
+    def __init__(self):
+        self.keys = {}
+        self.fetching = {}  # 地址 -> 下载这个密钥时持有的锁，不同密钥互不阻塞
+        self.lock = threading.Lock()
+
+    def get(self, uri):
+        with self.lock:
+            if uri in self.keys:
+                return self.keys[uri]
+            fetching = self.fetching.setdefault(uri, threading.Lock())
+        with fetching:
+            with self.lock:
+                if uri in self.keys:
+                    return self.keys[uri]
+            data = fetch_key(uri)
+            with self.lock:
+                self.keys[uri] = data
+                self.fetching.pop(uri, None)
+            return data
+
+# 下载密钥、初始化分片这类小文件，返回 (状态码, 内容)；网络错误和可重试的状态码按 retry_attempts 退避重试，
+# what 是失败提示里的名称
+def download_small_file(uri, what, headers=None):
+    attempt = 0
+    while True:
+        try:
+            response = get_session().get(uri, headers=headers, timeout=(connect_timeout, request_timeout))
+            check_status(uri, response.status_code, response.headers)
+            if response.status_code not in (200, 206):
+                raise SegmentError(f"HTTP {response.status_code}: {uri}", response.status_code, retryable=False)
+            return response.status_code, response.content
+        except Exception as e:
+            error = as_segment_error(e)
+            if not error.retryable or attempt >= retry_attempts:
+                raise error
+            delay = backoff_delay(attempt, error.retry_after)
+            print(f"下载{what}失败（{error}），{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            time.sleep(delay)
+            attempt += 1
+
+# 下载密钥
+def fetch_key(uri):
+    if not uri.startswith(("http://", "https://")):
+        with open(uri, 'rb') as f:
+            return f.read()
+    return download_small_file(uri, "密钥")[1]
+
+key_cache = KeyCache()
+
+# EXT-X-MAP 初始化分片缓存：同一个 (地址, 字节范围) 只下载一次；和密钥缓存一样，下载时只锁住这一项
+class InitSectionCache:
+    def __init__(self):
+        self.sections = {}
+        self.fetching = {}  # (地址, 字节范围) -> 下载时持有的锁
+        self.lock = threading.Lock()
+
+    def get(self, uri, byterange=None):
+        item = (uri, byterange)
+        with self.lock:
+            if item in self.sections:
+                return self.sections[item]
+            fetching = self.fetching.setdefault(item, threading.Lock())
+        with fetching:
+            with self.lock:
+                if item in self.sections:
+                    return self.sections[item]
+            data = fetch_init_section(uri, byterange)
+            with self.lock:
+                self.sections[item] = data
+                self.fetching.pop(item, None)
+            return data
+
+# 下载初始化分片（可能只是文件里的一段字节范围）
+def fetch_init_section(uri, byterange=None):
+    if not uri.startswith(("http://", "https://")):
+        with open(uri, 'rb') as f:
+            if byterange:
+                f.seek(byterange[0])
+            return f.read(byterange[1] if byterange else -1)
+    status, data = download_small_file(uri, "初始化分片", range_headers(b"", byterange))
+    return cut_byterange(status, data, byterange)
+
+init_cache = InitSectionCache()
+
+# 分片的 EXT-X-MAP 标识 (地址, 字节范围)，没有时返回 None；初始化分片的 BYTERANGE 省略偏移时从 0 开始
+def segment_map(segment):
+    section = segment.init_section
+    if section is None:
+        return None
+    byterange = None
+    if section.byterange:
+        length, _, offset = section.byterange.partition("@")
+        byterange = (int(offset or 0), int(length))
+    return absolute_uri(section), byterange
+
+# 按规范确定 IV：优先使用 IV 属性，否则用分片的媒体序号（128 位大端）
+def segment_iv(key, media_sequence):
+    if key.iv:
+        return bytes.fromhex(key.iv[2:] if key.iv.lower().startswith("0x") else key.iv).rjust(16, b"\0")
+    return media_sequence.to_bytes(16, "big")
+
+# 取分片对应的 (key, iv)；未加密返回 (None, None)
+def segment_key(segment):
+    key = segment.key
+    if key is None or key.method in (None, "NONE"):
+        return None, None
+    if key.method != "AES-128":
+        raise ValueError(f"不支持的加密方式: {key.method}")
+    if AES is None:
+        raise RuntimeError("播放列表已加密，请先安装 pycryptodome")
+    return key_cache.get(absolute_uri(key)), segment_iv(key, segment.media_sequence)
+
+# AES-128-CBC 解密并去掉 PKCS7 填充（放在模块顶层，进程池才能调用）
+def decrypt_segment(data, key, iv):
+    data = AES.new(key, AES.MODE_CBC, iv).decrypt(data[:len(data) - len(data) % 16])
+    pad = data[-1] if data else 0
+    if 1 <= pad <= 16 and data.endswith(bytes([pad]) * pad):
+        data = data[:-pad]
+    return data
+
+_decrypt_pool = None
+
+def get_decrypt_pool():
+    global _decrypt_pool
+    if _decrypt_pool is None:
+        executor = ProcessPoolExecutor if decrypt_executor == "process" else ThreadPoolExecutor
+        _decrypt_pool = executor(max_workers=decrypt_workers)
+    return _decrypt_pool
+
+# 断点续传日志：每行 "分片序号 大小 sha1 状态"，只追加写入，进程中断后也能读回
+class DownloadJournal:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.existed = os.path.exists(path)  # 没有旧日志说明上次没有中断，已有的输出文件不能续用
+        if self.existed:
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    # 最后一行可能因中断而不完整，直接忽略
+                    if len(parts) == 4 and parts[3] == "done" and len(parts[2]) == 40:
+                        self.entries[int(parts[0])] = (int(parts[1]), parts[2])
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, index, data):
+        size, digest = len(data), hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.entries[index] = (size, digest)
+            self.file.write(f"{index} {size} {digest} done\n")
+            self.file.flush()
+
+    def matches(self, index, data):
+        return self.entries.get(index) == (len(data), hashlib.sha1(data).hexdigest())
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+# 内容寻址的分片缓存：blobs/xx/<sha1> 保存去重后的分片内容（解密前的原始响应），
+# index.jsonl 按 (地址, 字节范围) 记录内容的 sha1、ETag、Last-Modified 和保存时间，只追加写入；
+# 内容文件的 mtime 就是最近使用时间，总大小超过 capacity 时先淘汰最久没用过的
+class SegmentCache:
+    def __init__(self, root, capacity):
+        self.root = root
+        self.capacity = capacity
+        self.entries = {}  # (地址, 字节范围) -> (sha1, ETag, Last-Modified, 保存时间)
+        self.blobs = OrderedDict()  # sha1 -> 大小，最久没用过的在前
+        self.size = 0
+        self.lock = threading.Lock()
+        blob_root = os.path.join(root, "blobs")
+        os.makedirs(blob_root, exist_ok=True)
+        found = []
+        for folder in os.listdir(blob_root):
+            for name in os.listdir(os.path.join(blob_root, folder)):
+                if len(name) == 40:  # 跳过写了一半的临时文件
+                    stat = os.stat(os.path.join(blob_root, folder, name))
+                    found.append((stat.st_mtime, name, stat.st_size))
+        for _, digest, size in sorted(found):
+            self.blobs[digest] = size
+            self.size += size
+        index, lines = os.path.join(root, "index.jsonl"), 0
+        if os.path.exists(index):
+            with open(index, encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue  # 中断时写了一半的行
+                    key = (item["url"], tuple(item["range"]) if item["range"] else None)
+                    self.entries[key] = (item["sha1"], item["etag"], item["modified"], item["stored"])
+        self.entries = {key: entry for key, entry in self.entries.items() if entry[0] in self.blobs}
+        if lines > 2 * len(self.entries) + 1000:
+            # 重复和失效的行太多时重写索引
+            with open(index + ".tmp", "w", encoding="utf-8") as f:
+                for key, entry in self.entries.items():
+                    f.write(self._line(key, entry))
+            os.replace(index + ".tmp", index)
+        self.file = open(index, "a", encoding="utf-8")
+        self.evict()
+
+    def _line(self, key, entry):
+        return json.dumps({"url": key[0], "range": key[1], "sha1": entry[0], "etag": entry[1],
+                           "modified": entry[2], "stored": entry[3]}) + "\n"
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    # 任务里每个分片的缓存键；合并请求的任务按各分片的字节范围分别缓存
+    def keys(self, task):
+        if task.parts is None:
+            return [(task.url, task.byterange)]
+        keys, offset = [], task.byterange[0]
+        for _, length, _, _ in task.parts:
+            keys.append((task.url, (offset, length)))
+            offset += length
+        return keys
+
+    # 取出任务的缓存内容：全部命中且没有过期时返回 (内容, None)；只有一个分片且已过期时返回
+    # (内容, 条件请求头)，源站回 304 时仍可使用；其他情况返回 (None, None)
+    def lookup(self, task):
+        with self.lock:
+            entries = [self.entries.get(key) for key in self.keys(task)]
+            if not all(entry and entry[0] in self.blobs for entry in entries):
+                return None, None
+            for entry in entries:
+                self.blobs.move_to_end(entry[0])
+        now = time.time()
+        fresh = segment_cache_ttl is None or all(now - entry[3] < segment_cache_ttl for entry in entries)
+        if not fresh and len(entries) > 1:
+            return None, None
+        try:
+            data = b"".join(self.read(entry[0]) for entry in entries)
+        except OSError:
+            return None, None  # 被另一个进程淘汰了
+        if fresh:
+            return data, None
+        _, etag, modified, _ = entries[0]
+        conditional = {}
+        if etag:
+            conditional["If-None-Match"] = etag
+        if modified:
+            conditional["If-Modified-Since"] = modified
+        return (data, conditional) if conditional else (None, None)
+
+    def read(self, digest):
+        path = self.blob_path(digest)
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)  # 记录最近使用时间，下次运行按它排序
+        return data
+
+    # 保存任务下载到的原始分片 [(序号, 数据, key, iv)]；内容相同的分片只存一份
+    def store(self, task, pieces, validators):
+        now = time.time()
+        for key, (_, data, _, _) in zip(self.keys(task), pieces):
+            if not data:
+                continue
+            digest = hashlib.sha1(data).hexdigest()
+            self._write_blob(digest, data)
+            entry = (digest, validators.get("ETag"), validators.get("Last-Modified"), now)
+            with self.lock:
+                self.entries[key] = entry
+                self.file.write(self._line(key, entry))
+                self.file.flush()
+        self.evict()
+
+    def _write_blob(self, digest, data):
+        path = self.blob_path(digest)
+        with self.lock:
+            if digest in self.blobs:
+                self.blobs.move_to_end(digest)
+                return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名，其他进程不会读到写了一半的内容
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if digest not in self.blobs:
+                self.blobs[digest] = len(data)
+                self.size += len(data)
+
+    # 缓存的内容校验不通过（磁盘损坏或被改动），删掉这些分片
+    def discard(self, task):
+        with self.lock:
+            for key in self.keys(task):
+                entry = self.entries.pop(key, None)
+                if entry and entry[0] in self.blobs:
+                    self.size -= self.blobs.pop(entry[0])
+                    self._remove(entry[0])
+
+    def evict(self):
+        with self.lock:
+            while self.size > self.capacity and self.blobs:
+                digest, size = self.blobs.popitem(last=False)
+                self.size -= size
+                self._remove(digest)
+
+    def _remove(self, digest):
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError:
+            pass
+
+_segment_cache = None
+
+# 没有设置 segment_cache_dir 时返回 None
+def get_segment_cache():
+    global _segment_cache
+    if _segment_cache is None and segment_cache_dir:
+        _segment_cache = SegmentCache(segment_cache_dir, segment_cache_size)
+    return _segment_cache
+
+# ts_files 里的文件名 "testNNN.ts" 对应的分片序号，不是分片文件时返回 None
+def ts_file_index(ts_file):
+    if ts_file.startswith("test") and ts_file.endswith(".ts") and ts_file[4:-3].isdigit():
+        return int(ts_file[4:-3])
+    return None
+
+# 把分片逐个写到 ts_files 文件夹，之后由 merge_ts_files 合并
+class TsFolderSink:
+    window = None
+
+    def __init__(self, folder=None, journal=None):
+        self.folder = folder or output_folder
+        self.journal = journal
+        self.discontinuities = set()  # 不连续点的分片序号，合并时交给转封装
+        self.indices = set()  # 本次下载的分片序号（含续传跳过的），合并时只合并这些
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # 文件夹里的分片只有属于同一个日志时才能续用，否则是别的视频或上次正常结束前留下的，先清掉
+        owner = os.path.join(self.folder, ".journal")
+        journal_path = os.path.abspath(journal.path) if journal else ""
+        try:
+            with open(owner, encoding="utf-8") as f:
+                self.trusted = bool(journal_path) and journal.existed and f.read() == journal_path
+        except OSError:
+            self.trusted = False
+        if not self.trusted:
+            for ts_file in os.listdir(self.folder):
+                if ts_file_index(ts_file) is not None:
+                    os.remove(os.path.join(self.folder, ts_file))
+        with open(owner, "w", encoding="utf-8") as f:
+            f.write(journal_path)
+
+    def path(self, index):
+        return os.path.join(self.folder, f"test{index:011}.ts")
+
+    # 检查已有分片：与日志一致的直接跳过，日志里没有记录的当作未下载完，用 Range 续传
+    def resume(self):
+        done, partials = set(), {}
+        if not self.trusted:
+            return done, partials
+        for ts_file in os.listdir(self.folder):
+            index = ts_file_index(ts_file)
+            if index is None:
+                continue
+            with open(self.path(index), 'rb') as ts:
+                data = ts.read()
+            if self.journal.matches(index, data):
+                done.add(index)
+            elif index not in self.journal.entries and data:
+                partials[index] = data
+        self.indices.update(done)
+        return done, partials
+
+    def put(self, index, data):
+        started = time.monotonic()
+        self.indices.add(index)
+        with open(self.path(index), 'wb') as f:
+            f.write(data)
+        if self.journal:
+            self.journal.record(index, data)
+        metrics.record_write(metrics.default_job, len(data), time.monotonic() - started)
+
+    def close(self):
+        pass
+
+# 输出文件是否转封装为分片 MP4
+def should_remux(output_file):
+    if ts_remux is None:
+        return False
+    if remux_mp4 == "auto":
+        return output_file.lower().endswith(".mp4")
+    return bool(remux_mp4)
+
+# 输出到标准输出（"-"）或命名管道：只能按顺序写，无法回头校验和续传
+def is_pipe_output(output_file):
+    if output_file == "-":
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(output_file).st_mode)
+    except OSError:
+        return False
+
+# 重排缓冲区：分片按完成顺序放入，按播放列表顺序直接追加到输出文件（remux 时经过转封装再写入）；
+# 输出是管道时由单独的线程写出，读取方慢时只有这个线程阻塞，分片写出后才释放窗口名额，
+# 预读的分片数受重排窗口限制，下载速度跟着读取方走；转封装是纯 Python 的 CPU 计算，同样交给写出线程，
+# 异步引擎的事件循环不会被它卡住
+class ReorderBuffer:
+    def __init__(self, output_file, window=None, journal=None, remux=False):
+        self.output_file = output_file
+        self.window = window or reorder_window
+        self.journal = journal
+        self.pipe = is_pipe_output(output_file)
+        # 续传时保留已有内容，由 resume() 截断到校验通过的位置
+        self.resuming = bool(journal and journal.existed and os.path.exists(output_file)) and not self.pipe
+        if output_file == "-":
+            self.file = open(sys.__stdout__.fileno(), 'wb', closefd=False)
+        else:
+            # 打开命名管道会一直等到有读取方
+            self.file = open(output_file, 'r+b' if self.resuming else 'wb')
+        self.writer = ts_remux.TsToFmp4(self.file) if remux else self.file
+        self.next_index = 0
+        self.pending = {}
+        self.discontinuities = set()  # 不连续点的分片序号，写到这里时通知转封装重新对齐时间轴
+        self.lock = threading.Lock()
+        self.on_flush = None  # 每写出一个分片调用一次，下载引擎用它释放窗口名额
+        self.error = None  # 管道被读取方关闭等写出错误，之后的 put 直接抛出
+        self.queue = queue.Queue() if self.pipe or remux else None
+        if self.queue:
+            self.thread = threading.Thread(target=self._drain, daemon=True)
+            self.thread.start()
+
+    # 逐段校验输出文件开头已写入的分片，截断到最后一个校验通过的分片之后；
+    # 末尾多出的、日志里还没有记录的字节是中断时写了一半的分片，交给 Range 续传
+    def resume(self):
+        done, partials = set(), {}
+        if not self.resuming:
+            return done, partials
+        offset = 0
+        while self.next_index in self.journal.entries:
+            size = self.journal.entries[self.next_index][0]
+            self.file.seek(offset)
+            if not self.journal.matches(self.next_index, self.file.read(size)):
+                break
+            done.add(self.next_index)
+            offset += size
+            self.next_index += 1
+        if self.next_index not in self.journal.entries:
+            self.file.seek(offset)
+            tail = self.file.read()
+            if tail:
+                partials[self.next_index] = tail
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        return done, partials
+
+    def put(self, index, data):
+        if self.error:
+            raise self.error
+        with self.lock:
+            self.pending[index] = data
+            while self.next_index in self.pending:
+                data = self.pending.pop(self.next_index)
+                if self.queue:
+                    self.queue.put((self.next_index, data))
+                else:
+                    self._write(self.next_index, data)
+                    if self.on_flush:
+                        self.on_flush()
+                self.next_index += 1
+
+    def _write(self, index, data):
+        started = time.monotonic()
+        if index in self.discontinuities and self.writer is not self.file:
+            self.writer.discontinuity()
+        self.writer.write(data)
+        if self.journal:
+            self.file.flush()
+            self.journal.record(index, data)
+        metrics.record_write(self.output_file, len(data), time.monotonic() - started)
+
+    # 管道和转封装输出的写出线程；出错后不再写，但仍然释放名额，避免下载引擎卡在窗口上
+    def _drain(self):
+        while (item := self.queue.get()) is not None:
+            if self.error is None:
+                try:
+                    self._write(*item)
+                    if self.pipe:
+                        self.file.flush()
+                except Exception as e:
+                    self.error = e
+                    print(f"输出管道已关闭（{e}），停止下载" if self.pipe and isinstance(e, OSError)
+                          else f"写出失败（{e}），停止下载")
+            if self.on_flush:
+                self.on_flush()
+
+    def close(self):
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+        try:
+            if self.writer is not self.file:
+                self.writer.close()
+            self.file.close()
+        except OSError:
+            if not self.error:
+                raise
+        if self.pending:
+            print(f"警告: 有 {len(self.pending)} 个分片因前面的分片缺失而未写出")
+        if self.error:
+            raise self.error
+
+# HEAD 请求得到的分片大小；压缩、没有 Content-Length 或请求失败时返回 None
+def head_length(url):
+    try:
+        response = get_session().head(url, allow_redirects=True, timeout=(connect_timeout, request_timeout))
+    except requests.RequestException:
+        return None
+    if response.status_code != 200 or response.headers.get("Content-Encoding"):
+        return None
+    return expected_length(response.headers)
+
+# 预先确定每个分片写出后的大小 {序号: 字节数}：字节范围分片直接用播放列表里的长度，其余并发发 HEAD 请求；
+# 加密分片（去掉填充后的长度解密了才知道）或有分片得不到大小时返回 None
+def segment_sizes(tasks):
+    if any(key for task in tasks for _, _, key, _ in (task.parts or [(None, None, task.key, None)])):
+        return None
+    heads = [task for task in tasks if task.byterange is None]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, max_connections_per_host))) as pool:
+        lengths = dict(zip([task.index for task in heads], pool.map(head_length, [task.url for task in heads])))
+    sizes = {}
+    for task in tasks:
+        if task.parts:
+            sizes.update((index, length) for index, length, _, _ in task.parts)
+        elif task.byterange:
+            sizes[task.index] = task.byterange[1]
+        elif lengths[task.index] is None:
+            return None
+        else:
+            sizes[task.index] = lengths[task.index]
+        sizes[task.index] += len(task.init or b"")
+    return sizes
+
+# 预分配输出：layout 按各分片的大小算好偏移并预分配整个文件，分片下载完成后直接 pwrite 到自己的位置，
+# 完成顺序与写入顺序无关，没有重排窗口、临时文件和合并；
+# 实际大小与预期不符的分片先写到旁边的文件，结束时按顺序重写一遍输出
+class PositionalSink:
+    window = None
+    discontinuities = None  # 预分配模式不转封装，不记录不连续点
+
+    def __init__(self, output_file, journal=None):
+        self.output_file = output_file
+        self.journal = journal
+        self.offsets = {}  # 序号 -> (偏移, 大小)
+        self.pending = set()  # 还没写出的分片
+        self.misfits = {}  # 序号 -> 旁路文件
+        self.fd = None
+        self.lock = threading.Lock()
+
+    # 布局要等生成任务之后才能确定，已完成的分片由 layout 检查
+    def resume(self):
+        return set(), {}
+
+    # 确定布局并预分配输出文件，返回已完成（续传时与日志一致）的分片序号；分片大小无法预先确定时返回 None
+    def layout(self, tasks):
+        sizes = segment_sizes(tasks)
+        if sizes is None:
+            return None
+        offset = 0
+        for index in sorted(sizes):
+            self.offsets[index] = (offset, sizes[index])
+            offset += sizes[index]
+        resuming = bool(self.journal and self.journal.existed and os.path.exists(self.output_file))
+        self.fd = os.open(self.output_file, os.O_RDWR | os.O_CREAT | (0 if resuming else os.O_TRUNC), 0o666)
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, offset)
+            except OSError:
+                pass  # 文件系统不支持预分配，写入时再分配
+        os.ftruncate(self.fd, offset)
+        done = set()
+        if resuming:
+            for index, (start, size) in self.offsets.items():
+                if (self.journal.entries.get(index, (None,))[0] == size
+                        and self.journal.matches(index, os.pread(self.fd, size, start))):
+                    done.add(index)
+        self.pending = set(self.offsets) - done
+        return done
+
+    def put(self, index, data):
+        started = time.monotonic()
+        start, size = self.offsets[index]
+        if len(data) == size:
+            view, written = memoryview(data), 0
+            while written < size:
+                written += os.pwrite(self.fd, view[written:], start + written)
+            if self.journal:
+                self.journal.record(index, data)
+        else:
+            path = f"{self.output_file}.{index}.part"
+            with open(path, 'wb') as f:
+                f.write(data)
+            with self.lock:
+                self.misfits[index] = path
+        with self.lock:
+            self.pending.discard(index)
+        metrics.record_write(self.output_file, len(data), time.monotonic() - started)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.misfits:
+            print(f"警告: {len(self.misfits)} 个分片的实际大小与预期不符，按顺序重写输出文件")
+            self._rewrite()
+        os.close(self.fd)
+        self.fd = None
+        if self.pending:
+            print(f"警告: 有 {len(self.pending)} 个分片未写出")
+
+    def _rewrite(self):
+        with open(self.output_file + ".tmp", 'wb') as f:
+            for index, (start, size) in sorted(self.offsets.items()):
+                if index in self.misfits:
+                    with open(self.misfits[index], 'rb') as part:
+                        f.write(part.read())
+                else:
+                    f.write(os.pread(self.fd, size, start))
+        os.replace(self.output_file + ".tmp", self.output_file)
+        for path in self.misfits.values():
+            os.remove(path)
+
+# 读取播放列表：本地文件直接解析，网络地址用共享 Session 获取；
+# msn 不为空时带上 _HLS_msn 做阻塞式刷新，服务器会等到该媒体序号出现才返回
+def load_playlist(uri, msn=None, timeout=None):
+    if not uri.startswith(("http://", "https://")):
+        if playlist_parser != "lean":
+            return m3u8.load(uri)
+        with open(uri, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        params = {"_HLS_msn": msn} if msn is not None else None
+        response = get_session().get(uri, params=params, timeout=timeout)
+        # 和分片一样区分可重试的状态码（503、429 等）和直接放弃的（404 等）
+        check_status(uri, response.status_code, response.headers)
+        text = response.text
+    if playlist_parser == "lean":
+        playlist = LeanPlaylist(text, uri)
+        if playlist.supported:
+            return playlist
+    return m3u8.loads(text, uri=uri)
+
+# 精简解析器认识的标签；出现其他标签（主播放列表、LL-HLS 的 PART/SKIP、GAP 等）时整个播放列表交给 m3u8 库
+LEAN_TAGS = frozenset((
+    "EXTM3U", "EXTINF", "EXT-X-VERSION", "EXT-X-TARGETDURATION", "EXT-X-MEDIA-SEQUENCE",
+    "EXT-X-DISCONTINUITY-SEQUENCE", "EXT-X-PLAYLIST-TYPE", "EXT-X-ENDLIST", "EXT-X-INDEPENDENT-SEGMENTS",
+    "EXT-X-ALLOW-CACHE", "EXT-X-START", "EXT-X-BYTERANGE", "EXT-X-KEY", "EXT-X-MAP",
+    "EXT-X-PROGRAM-DATE-TIME", "EXT-X-DISCONTINUITY", "EXT-X-DATERANGE", "EXT-X-BITRATE",
+    "EXT-X-CUE-OUT", "EXT-X-CUE-OUT-CONT", "EXT-X-CUE-IN", "EXT-OATCLS-SCTE35",
+))
+_TAG_RE = re.compile(r"^#(EXT[^:\r\n]*)", re.M)
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+# 解析标签的属性列表 KEY=VALUE,KEY="VALUE"
+def parse_attributes(value):
+    return {name: item.strip('"') for name, item in _ATTR_RE.findall(value)}
+
+# 按 m3u8 库的规则拼出绝对地址：网络播放列表按 URL 拼接，本地播放列表按所在目录拼接
+def join_uri(base, uri):
+    if base.startswith(("http://", "https://")) or "://" in uri:
+        return urljoin(base, uri)
+    return os.path.normpath(os.path.join(os.path.dirname(base), uri))
+
+# 解析 EXT-X-PROGRAM-DATE-TIME，格式不规范时返回 None
+def parse_date_time(value):
+    try:
+        return datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+# 精简解析器的 EXT-X-KEY 和 EXT-X-MAP：同一个标签之后的分片共用一个对象，URI 解析时已转成绝对地址
+class LeanKey:
+    __slots__ = ("method", "uri", "iv")
+    base_uri = None
+
+    def __init__(self, method, uri, iv):
+        self.method, self.uri, self.iv = method, uri, iv
+
+class LeanMap:
+    __slots__ = ("uri", "byterange")
+    base_uri = None
+
+    def __init__(self, uri, byterange):
+        self.uri, self.byterange = uri, byterange
+
+# 精简的分片记录，字段名和 m3u8 库的 Segment 一致，下载流程不用区分两种解析结果
+class LeanSegment:
+    __slots__ = ("uri", "duration", "byterange", "key", "init_section", "media_sequence",
+                 "program_date_time", "discontinuity", "cue_out_start", "cue_out", "cue_in", "scte35_duration")
+    base_uri = None
+
+    def __init__(self, uri, duration, byterange, key, init_section, media_sequence, program_date_time,
+                 discontinuity, cues=(False, False, False, None)):
+        self.uri = uri
+        self.duration = duration
+        self.byterange = byterange
+        self.key = key
+        self.init_section = init_section
+        self.media_sequence = media_sequence
+        self.program_date_time = program_date_time
+        self.discontinuity = discontinuity
+        self.cue_out_start, self.cue_out, self.cue_in, self.scte35_duration = cues
+
+# 逐行解析的媒体播放列表：用正则一次扫出所有标签，supported 表示能否处理；之后 iter_segments() 边读边产出分片记录，
+# 第一次访问 segments 时才生成完整列表
+class LeanPlaylist:
+    is_variant = False
+    server_control = None
+
+    def __init__(self, text, uri):
+        self.text = text
+        self.uri = uri
+        tags = set(_TAG_RE.findall(text))
+        self.supported = text.lstrip("\ufeff").startswith("#EXTM3U") and tags <= LEAN_TAGS
+        self.is_endlist = "EXT-X-ENDLIST" in tags
+        self.count = text.count("#EXTINF")
+        self.target_duration = None
+        self.media_sequence = 0
+        for line in io.StringIO(text):
+            if line.startswith("#EXTINF"):
+                break
+            if line.startswith("#EXT-X-TARGETDURATION:"):
+                self.target_duration = int(float(line.partition(":")[2]))
+            elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                self.media_sequence = int(line.partition(":")[2])
+        self.prefix = join_uri(uri, "x")[:-1]
+        self._segments = None
+
+    # 普通的相对路径直接接在播放列表所在目录后面，省去逐个分片 urljoin 的开销
+    def resolve(self, uri):
+        if "://" in uri:
+            return uri
+        if uri[0] in "/.?#" or ":" in uri:
+            return join_uri(self.uri, uri)
+        return self.prefix + uri
+
+    @property
+    def segments(self):
+        if self._segments is None:
+            self._segments = list(self.iter_segments())
+        return self._segments
+
+    def iter_segments(self):
+        if self._segments is not None:
+            yield from self._segments
+            return
+        sequence = self.media_sequence
+        duration = byterange = date_time = None
+        key = init_section = None
+        discontinuity = False
+        cues = no_cues = (False, False, False, None)
+        for line in io.StringIO(self.text):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith("#"):
+                yield LeanSegment(self.resolve(line), duration, byterange, key, init_section, sequence,
+                                  date_time, discontinuity, cues)
+                sequence += 1
+                duration = byterange = date_time = None
+                discontinuity = False
+                cues = no_cues
+                continue
+            tag, _, value = line[1:].partition(":")
+            if tag == "EXTINF":
+                duration = float(value.partition(",")[0])
+            elif tag == "EXT-X-BYTERANGE":
+                byterange = value
+            elif tag == "EXT-X-KEY":
+                attrs = parse_attributes(value)
+                uri = attrs.get("URI")
+                key = LeanKey(attrs.get("METHOD"), self.resolve(uri) if uri else None, attrs.get("IV"))
+            elif tag == "EXT-X-MAP":
+                attrs = parse_attributes(value)
+                init_section = LeanMap(self.resolve(attrs["URI"]), attrs.get("BYTERANGE"))
+            elif tag == "EXT-X-PROGRAM-DATE-TIME":
+                date_time = parse_date_time(value)
+            elif tag == "EXT-X-DISCONTINUITY":
+                discontinuity = True
+            elif tag == "EXT-X-CUE-OUT":
+                # 和 m3u8 库一样保留声明的时长原文："DURATION=30" 或直接写 "30"
+                cue_duration = parse_attributes(value).get("DURATION") if "=" in value else value
+                cues = (True, True, cues[2], cue_duration or None)
+            elif tag == "EXT-X-CUE-OUT-CONT":
+                cues = (cues[0], True, cues[2], cues[3])
+            elif tag == "EXT-X-CUE-IN":
+                cues = (cues[0], cues[1], True, cues[3])
+
+# 直播刷新播放列表：网络错误和可重试的状态码按分片的退避规则重试，一次刷新失败不中断整个录制
+def reload_playlist(m3u8_file, msn=None, timeout=None):
+    attempt = 0
+    while True:
+        try:
+            return load_playlist(m3u8_file, msn=msn, timeout=timeout)
+        except Exception as e:
+            error = as_segment_error(e)
+            if not error.retryable or attempt >= retry_attempts:
+                raise error
+            delay = backoff_delay(attempt, error.retry_after)
+            print(f"刷新播放列表失败（{error}），{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            time.sleep(delay)
+            attempt += 1
+
+# 跟随直播/EVENT 播放列表：按 EXT-X-TARGETDURATION 定时刷新，只产出新出现的媒体序号，
+# 遇到 EXT-X-ENDLIST 结束；服务器声明 CAN-BLOCK-RELOAD 时改用 _HLS_msn 阻塞式刷新
+def follow_playlist(m3u8_file, m3u8_obj=None):
+    m3u8_obj = m3u8_obj or load_playlist(m3u8_file)
+    loaded_at = time.monotonic()
+    next_msn = None
+    while True:
+        changed = False
+        for segment in m3u8_obj.segments:
+            msn = segment.media_sequence
+            if next_msn is not None and msn < next_msn:
+                continue
+            if next_msn is not None and msn > next_msn:
+                print(f"警告: 媒体序号 {next_msn}-{msn - 1} 已滑出播放列表窗口，无法下载")
+            next_msn = msn + 1
+            changed = True
+            yield segment
+        if m3u8_obj.is_endlist:
+            return
+
+        target = m3u8_obj.target_duration or 6
+        server_control = getattr(m3u8_obj, "server_control", None)
+        if server_control and server_control.can_block_reload == "YES" and next_msn is not None:
+            m3u8_obj = reload_playlist(m3u8_file, msn=next_msn, timeout=target * 3)
+        else:
+            # 按规范：有新分片时等一个目标时长再刷新，没有变化时等半个
+            delay = target if changed else target / 2
+            time.sleep(max(0, delay - (time.monotonic() - loaded_at)))
+            m3u8_obj = reload_playlist(m3u8_file)
+        loaded_at = time.monotonic()
+
+# 续传时只请求 partial 之后的字节；byterange 为 (偏移, 长度) 时只请求文件里的这一段；
+# conditional 是分片缓存过期时的条件请求头
+def range_headers(partial, byterange=None, conditional=None):
+    headers = dict(conditional or {})
+    if byterange:
+        offset, length = byterange
+        headers["Range"] = f"bytes={offset + len(partial)}-{offset + length - 1}"
+    elif partial:
+        headers["Range"] = f"bytes={len(partial)}-"
+    return headers or None
+
+# 服务器不支持 Range 时返回了整个文件，自己截出需要的那一段
+def cut_byterange(status, data, byterange):
+    if byterange and status == 200:
+        return data[byterange[0]:byterange[0] + byterange[1]]
+    return data
+
+# 分片下载失败；retryable 表示值得重试（连接错误、超时、408/425/429/5xx、内容不完整）
+class SegmentError(Exception):
+    def __init__(self, message, status=None, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+# 分片内容不是合法的 MPEG-TS（错误页面、被截断、包丢失），网络层其实是成功的
+class InvalidSegment(SegmentError):
+    pass
+
+# 把各种异常统一成 SegmentError：网络层的错误都可以重试，其他异常（程序错误）不重试
+def as_segment_error(error):
+    if isinstance(error, SegmentError):
+        return error
+    # 直接 readinto 时连接中断抛出的是 urllib3 的异常，没有经过 requests 包装
+    network_errors = (requests.RequestException, urllib3.exceptions.HTTPError, asyncio.TimeoutError, ConnectionError)
+    if aiohttp is not None:
+        network_errors += (aiohttp.ClientError,)
+    return SegmentError(f"{type(error).__name__}: {error}", retryable=isinstance(error, network_errors))
+
+# 检查响应状态，非 2xx 时抛出 SegmentError
+def check_status(url, status, headers):
+    if status in (200, 206, 304, 416):
+        return
+    retry_after = headers.get("Retry-After")
+    retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+    raise SegmentError(f"HTTP {status}: {url}", status, status in retry_statuses, retry_after)
+
+# 没有压缩时核对 Content-Length，防止连接中途断开留下不完整的分片
+def check_length(url, status, headers, received):
+    expected = headers.get("Content-Length")
+    if expected and not headers.get("Content-Encoding") and received != int(expected):
+        raise SegmentError(f"内容不完整（{received}/{expected} 字节）: {url}", status)
+
+# 416 只有在已有部分正好是完整分片时才算成功：Content-Range 给出的总长度必须等于已有部分的长度，
+# 对不上（已有部分来自别的文件，或者请求的字节范围本身越界）时丢掉已有部分整段重下
+def check_unsatisfiable(url, headers, partial):
+    total = headers.get("Content-Range", "").rpartition("/")[2]
+    if not partial or not total.isdigit() or int(total) != len(partial):
+        raise InvalidSegment(f"HTTP 416，已有的 {len(partial)} 字节与分片总长度 {total or '未知'} 不符: {url}", 416)
+
+# fMP4/CMAF 分片的扩展名，按 MP4 box 结构校验
+mp4_extensions = (".m4s", ".mp4", ".m4a", ".m4v", ".cmfv", ".cmfa", ".cmft")
+# 分片开头是这些 box 时同样按 MP4 校验
+mp4_box_types = (b"ftyp", b"styp", b"sidx", b"moof", b"emsg", b"prft", b"moov", b"free", b"uuid")
+# 这些扩展名的分片既不是 TS 也不是 MP4，不做校验
+non_ts_extensions = (".aac", ".ac3", ".ec3", ".mp3", ".vtt", ".webvtt")
+
+# 校验 MPEG-TS 数据，返回问题描述，没有问题时返回 None：长度是 188 的整数倍、每个包以 0x47 开头
+# （被截断或收到错误页面时重试可以恢复）
+def validate_ts(data):
+    if not data:
+        return "空分片"
+    if len(data) % 188:
+        return f"长度 {len(data)} 不是 188 的整数倍"
+    if np is None:
+        # 切片取出所有同步字节一次比较
+        if data[::188].count(b"\x47") != len(data) // 188:
+            return "同步字节错误"
+        return None
+    bad = np.flatnonzero(np.frombuffer(data, dtype=np.uint8)[::188] != 0x47)
+    if bad.size:
+        return f"第 {bad[0]} 个包的同步字节错误"
+    return None
+
+# 统计连续计数器跳变：同一 PID 带负载的包计数器逐个加一（允许重复一次，自适应字段标记了不连续的除外）。
+# 录制的广播流、拼接过的流本身就可能有跳变，重试拿到的还是同样的字节，所以只告警、不当作错误；
+# 整段数据当作 (包数, 188) 的二维数组一次算完，没有逐包的 Python 循环；没有 NumPy 时不检查
+def continuity_gaps(data):
+    if np is None:
+        return 0
+    packets = np.frombuffer(data, dtype=np.uint8).reshape(-1, 188)
+    pid = (packets[:, 1].astype(np.uint16) & 0x1F) << 8 | packets[:, 2]
+    control = packets[:, 3] >> 4
+    discontinuity = (control & 2 == 2) & (packets[:, 4] > 0) & (packets[:, 5] & 0x80 == 0x80)
+    # 只有带负载的包才递增计数器；空包 (PID 0x1FFF) 不计
+    has_payload = (control & 1 == 1) & (pid != 0x1FFF)
+    pid, counter, discontinuity = pid[has_payload], packets[has_payload, 3] & 0x0F, discontinuity[has_payload]
+    # 按 PID 稳定排序，同一 PID 的包相邻且保持原来的先后顺序
+    order = np.argsort(pid, kind="stable")
+    pid, counter, discontinuity = pid[order], counter[order], discontinuity[order]
+    step = (counter[1:] - counter[:-1]) & 0x0F
+    broken = (pid[1:] == pid[:-1]) & ~discontinuity[1:] & (step > 1)
+    return int(broken.sum())
+
+# 校验 fMP4 分片：逐个 box 读出长度，必须正好铺满整段数据（分片只有寥寥几个 box）
+def validate_mp4(data):
+    offset, size = 0, len(data)
+    while offset < size:
+        if offset + 8 > size:
+            return f"第 {offset} 字节处的 box 头不完整"
+        length = int.from_bytes(data[offset:offset + 4], "big")
+        header = 8
+        if length == 1:
+            if offset + 16 > size:
+                return f"第 {offset} 字节处的 box 头不完整"
+            length, header = int.from_bytes(data[offset + 8:offset + 16], "big"), 16
+        elif length == 0:
+            length = size - offset  # 一直到数据末尾
+        if length < header or not all(32 <= c < 127 for c in data[offset + 4:offset + 8]):
+            return f"第 {offset} 字节处不是合法的 box"
+        offset += length
+    if offset != size:
+        return f"最后一个 box 不完整（缺 {offset - size} 字节）"
+    return None if size else "空分片"
+
+# 校验下载（并解密）后的分片，不合法时抛出可重试的 InvalidSegment；连续计数器跳变只告警并计入指标
+def check_segment(task, url, data, index):
+    path = urlsplit(url).path.lower()
+    if not validate_segments or path.endswith(non_ts_extensions):
+        return
+    if task.init or path.endswith(mp4_extensions) or data[4:8] in mp4_box_types:
+        problem = validate_mp4(data)
+    else:
+        problem = validate_ts(data)
+        gaps = 0 if problem else continuity_gaps(data)
+        if gaps:
+            metrics.record_continuity(task, url, gaps)
+            print(f"警告: 分片 {index} 有 {gaps} 处连续计数器跳变（源内容如此，照常使用）: {url}")
+    if problem:
+        raise InvalidSegment(f"分片校验失败（{problem}）: {url}")
+
+# 响应里的 ETag 和 Last-Modified，写入分片缓存，过期后用来发条件请求
+def cache_validators(headers):
+    return {name: headers[name] for name in ("ETag", "Last-Modified") if headers.get(name)}
+
+# 第 attempt 次重试前的等待时间，服务器给了 Retry-After 时以它为准
+def backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, retry_max_delay)
+    return random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+
+# 下载缓冲池：按 2 的幂容量分组复用 bytearray，分片不必每次重新分配内存、重新触发缺页
+class BufferPool:
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.free = {}  # 容量 -> [bytearray]
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        capacity = 1 << max(size - 1, 0xFFFF).bit_length()  # 至少 64 KiB
+        with self.lock:
+            if self.free.get(capacity):
+                self.size -= capacity
+                return self.free[capacity].pop()
+        return bytearray(capacity)
+
+    def release(self, buffer):
+        with self.lock:
+            if self.size + len(buffer) <= self.limit:
+                self.free.setdefault(len(buffer), []).append(buffer)
+                self.size += len(buffer)
+
+buffer_pool = BufferPool(buffer_pool_size)
+
+# 一个分片的接收缓冲区：知道长度时一次取够，不知道时写满了换一个两倍大的；
+# 读完后只复制一次得到 bytes，缓冲区放回池里
+class SegmentBuffer:
+    def __init__(self, prefix, expected=None):
+        self.length = len(prefix)
+        self.buffer = buffer_pool.acquire(self.length + (expected or read_chunk_size))
+        self.view = memoryview(self.buffer)
+        self.view[:self.length] = prefix
+
+    # 可以直接读入的空闲区域，最多 size 字节
+    def space(self, size):
+        if self.length == len(self.buffer):
+            self._grow(self.length * 2)
+        return self.view[self.length:self.length + size]
+
+    def _grow(self, capacity):
+        buffer = buffer_pool.acquire(capacity)
+        buffer[:self.length] = self.view[:self.length]
+        self.release()
+        self.buffer, self.view = buffer, memoryview(buffer)
+
+    def append(self, chunk):
+        if self.length + len(chunk) > len(self.buffer):
+            self._grow(self.length + len(chunk))
+        self.view[self.length:self.length + len(chunk)] = chunk
+        self.length += len(chunk)
+
+    # 取出内容（服务器不支持 Range 时返回了整个文件，只取 byterange 这一段），并归还缓冲区
+    def take(self, status, byterange):
+        start, end = 0, self.length
+        if byterange and status == 200:
+            start, end = min(byterange[0], end), min(byterange[0] + byterange[1], end)
+        data = self.view[start:end].tobytes()
+        self.release()
+        return data
+
+    def release(self):
+        if self.buffer is not None:
+            self.view.release()
+            buffer_pool.release(self.buffer)
+            self.buffer = None
+
+# 没有压缩时响应里的 Content-Length 就是要读的字节数
+def expected_length(headers):
+    length = headers.get("Content-Length")
+    return int(length) if length and length.isdigit() and not headers.get("Content-Encoding") else None
+
+# 下载TS文件，返回 (状态码, 分片内容, 缓存校验信息)；partial 为已下载的前半段，cancel 被设置时放弃下载，
+# limiter 在每次读到数据后按令牌桶限速；conditional 的条件请求命中时返回 304 和空内容
+def download_ts_file(url, partial=b"", cancel=None, limiter=None, byterange=None, conditional=None):
+    response = get_session().get(url, headers=range_headers(partial, byterange, conditional), stream=True,
+                                 timeout=(connect_timeout, request_timeout))
+    host = host_of(url)
+    with response:
+        status = response.status_code
+        check_status(url, status, response.headers)
+        validators = cache_validators(response.headers)
+        if status == 304:
+            return status, b"", validators
+        if status == 416:
+            check_unsatisfiable(url, response.headers, partial)
+            return status, partial, validators  # 已有部分其实就是完整分片
+        prefix = partial if status == 206 else b""
+        expected = expected_length(response.headers)
+        buffer = SegmentBuffer(prefix, expected)
+        # 压缩的响应交给 requests 解压，其余直接读进缓冲区，不产生逐块的 bytes 对象
+        chunks = response.iter_content(read_chunk_size) if response.headers.get("Content-Encoding") else None
+        try:
+            while expected is None or buffer.length - len(prefix) < expected:
+                if cancel is not None and cancel.is_set():
+                    raise SegmentError(f"已取消: {url}", status, retryable=False)
+                if chunks is None:
+                    n = response.raw.readinto(buffer.space(read_chunk_size))
+                    buffer.length += n
+                else:
+                    chunk = next(chunks, b"")
+                    buffer.append(chunk)
+                    n = len(chunk)
+                if not n:
+                    break
+                if limiter is not None:
+                    limiter.wait(host, n)
+            check_length(url, status, response.headers, buffer.length - len(prefix))
+            return status, buffer.take(status, byterange), validators
+        finally:
+            buffer.release()
+
+# 异步下载TS文件（共享 ClientSession 的连接池）
+async def download_ts_file_async(session, url, partial=b"", limiter=None, byterange=None, conditional=None):
+    host = host_of(url)
+    async with session.get(url, headers=range_headers(partial, byterange, conditional)) as response:
+        status = response.status
+        check_status(url, status, response.headers)
+        validators = cache_validators(response.headers)
+        if status == 304:
+            return status, b"", validators
+        if status == 416:
+            check_unsatisfiable(url, response.headers, partial)
+            return status, partial, validators
+        prefix = partial if status == 206 else b""
+        buffer = SegmentBuffer(prefix, expected_length(response.headers))
+        try:
+            # iter_any 按收到的数据块原样返回，不再切分拼接
+            async for chunk in response.content.iter_any():
+                buffer.append(chunk)
+                if limiter is not None:
+                    await limiter.wait_async(host, len(chunk))
+            check_length(url, status, response.headers, buffer.length - len(prefix))
+            return status, buffer.take(status, byterange), validators
+        finally:
+            buffer.release()
+
+# 对冲请求用的线程池（线程模式下载线程在这里发出真正的请求）
+_hedge_pool = None
+
+def get_hedge_pool():
+    global _hedge_pool
+    if _hedge_pool is None:
+        _hedge_pool = ThreadPoolExecutor(max_workers=max_workers * 2)
+    return _hedge_pool
+
+# 等待对冲中的两个请求，返回先成功的那个；都失败时抛出主请求的异常
+def _first_success(primary, backup):
+    pending = {primary, backup}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return primary.result()
+
+# 发出一次下载；超过该主机最近分片耗时的 p95 还没完成时再发一个相同请求（有镜像时发往另一个镜像）
+def fetch_hedged(task, url, conditional=None):
+    threshold = get_controller(host_of(url)).p95() if hedge_requests else None
+    if threshold is None:
+        return download_ts_file(url, task.partial, limiter=task.limiter, byterange=task.byterange,
+                                conditional=conditional)
+    cancel = threading.Event()
+    primary = get_hedge_pool().submit(download_ts_file, url, task.partial, cancel, task.limiter, task.byterange,
+                                      conditional)
+    try:
+        if wait([primary], timeout=threshold).done:
+            return primary.result()
+        print(f"分片 {task.index} 超过 p95（{threshold:.2f} 秒），发出对冲请求")
+        backup_url = mirror_pool.pick(task.url, avoid=host_of(url))
+        backup = get_hedge_pool().submit(download_ts_file, backup_url, task.partial, cancel, task.limiter,
+                                         task.byterange, conditional)
+        return _first_success(primary, backup)
+    finally:
+        cancel.set()  # 让落后的请求尽快停止
+
+async def fetch_hedged_async(session, task, url, conditional=None):
+    threshold = get_controller(host_of(url)).p95() if hedge_requests else None
+    primary = asyncio.ensure_future(download_ts_file_async(session, url, task.partial, task.limiter,
+                                                          task.byterange, conditional))
+    if threshold is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=threshold)
+    if done:
+        return primary.result()
+    print(f"分片 {task.index} 超过 p95（{threshold:.2f} 秒），发出对冲请求")
+    backup_url = mirror_pool.pick(task.url, avoid=host_of(url))
+    backup = asyncio.ensure_future(download_ts_file_async(session, backup_url, task.partial, task.limiter,
+                                                         task.byterange, conditional))
+    pending = {primary, backup}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for job in done:
+                if job.exception() is None:
+                    return job.result()
+        return primary.result()
+    finally:
+        for job in pending:
+            job.cancel()
+
+# 每次尝试的结果都报告给该主机的并发控制器和镜像统计；可重试的错误按退避时间等待后重试
+def _retry_or_raise(task, url, error, attempt, started):
+    error = as_segment_error(error)
+    elapsed = time.monotonic() - started
+    # 内容校验失败时请求本身已记为成功，不再算作源站拥塞，只降低该镜像的权重
+    if not isinstance(error, InvalidSegment):
+        get_controller(host_of(url)).record(0, elapsed, error.status)
+    mirror_pool.record(url, 0, elapsed, False)
+    if isinstance(error, InvalidSegment):
+        task.partial = b""  # 续传的前半段可能就是坏的，重试时整段重下
+    retried = error.retryable and attempt < retry_attempts
+    metrics.record_failure(task, url, error, retried)
+    if not retried:
+        raise error
+    delay = backoff_delay(attempt, error.retry_after)
+    print(f"分片 {task.index} 下载失败（{error}），{delay:.1f} 秒后第 {attempt + 1} 次重试")
+    return delay
+
+def _record_success(task, url, status, data, started):
+    task.size, task.elapsed = len(data), time.monotonic() - started
+    get_controller(host_of(url)).record(task.size, task.elapsed, status)
+    mirror_pool.record(url, task.size, task.elapsed, True)
+    metrics.record_request(task, url, status, task.size, task.elapsed)
+
+# 合并下载的数据按各分片的长度切回去，返回 [(序号, 数据, key, iv)]
+def split_parts(task, url, data):
+    if task.parts is None:
+        return [(task.index, data, task.key, task.iv)]
+    if len(data) != task.byterange[1]:
+        raise InvalidSegment(f"字节范围不完整（{len(data)}/{task.byterange[1]} 字节）: {url}")
+    pieces, offset = [], 0
+    for index, length, key, iv in task.parts:
+        pieces.append((index, data[offset:offset + length], key, iv))
+        offset += length
+    return pieces
+
+# 解密后的分片：切换了 EXT-X-MAP 的第一个分片前面补上初始化分片，再逐个校验，返回 [(序号, 数据)]
+def finish_pieces(task, url, pieces):
+    finished = []
+    for index, piece, _, _ in pieces:
+        if task.init and index == task.index:
+            piece = task.init + piece
+        check_segment(task, url, piece, index)
+        finished.append((index, piece))
+    return finished
+
+# 解密各分片，返回 [(序号, 数据, key, iv)]
+def decrypt_pieces(pieces):
+    if not any(key and piece for _, piece, key, _ in pieces):
+        return pieces
+    pool = get_decrypt_pool()
+    jobs = [pool.submit(decrypt_segment, piece, key, iv) if key and piece else None for _, piece, key, iv in pieces]
+    return [(index, job.result() if job else piece, key, iv) for (index, piece, key, iv), job in zip(pieces, jobs)]
+
+# 交给解密池，解密与其他分片的网络读取同时进行
+async def decrypt_pieces_async(pieces):
+    if not any(key and piece for _, piece, key, _ in pieces):
+        return pieces
+    loop = asyncio.get_running_loop()
+    pool = get_decrypt_pool()
+    jobs = [loop.run_in_executor(pool, decrypt_segment, piece, key, iv) if key and piece else None
+            for _, piece, key, iv in pieces]
+    return [(index, await job if job else piece, key, iv) for (index, piece, key, iv), job in zip(pieces, jobs)]
+
+# 分片缓存里有这个任务且没有过期时直接取用，返回 (结果, 缓存内容, 条件请求头)；
+# 直接取用时结果为 [(序号, 数据)]，否则为 None，缓存内容和条件请求头留给之后的条件请求
+def cached_pieces(task, url):
+    cache = get_segment_cache()
+    if cache is None:
+        return None, None, None
+    cached, conditional = cache.lookup(task)
+    if cached is None or conditional is not None:
+        return None, cached, conditional
+    try:
+        pieces = finish_pieces(task, url, decrypt_pieces(split_parts(task, url, cached)))
+    except InvalidSegment as e:
+        print(f"缓存的分片 {task.index} 不可用（{e}），重新下载")
+        cache.discard(task)
+        return None, None, None
+    metrics.record_cache_hit(task, len(cached))
+    return pieces, None, None
+
+# 下载并解密一个任务的分片，失败或校验不通过时带抖动退避重试；url 是已选好的镜像地址，重试时换一个镜像；
+# 返回 [(序号, 数据)]，合并请求的任务包含多个分片；开启分片缓存时先查缓存，下载成功后写入缓存
+def fetch_segment(task, url):
+    pieces, cached, conditional = cached_pieces(task, url)
+    if pieces is not None:
+        return pieces
+    for attempt in range(retry_attempts + 1):
+        if attempt:
+            url = mirror_pool.pick(task.url, avoid=host_of(url))
+        started = time.monotonic()
+        try:
+            status, data, validators = fetch_hedged(task, url, conditional)
+            _record_success(task, url, status, data, started)
+            # 304: 源站确认缓存的内容仍然有效
+            raw = split_parts(task, url, cached if status == 304 else data)
+        except Exception as e:
+            time.sleep(_retry_or_raise(task, url, e, attempt, started))
+            continue
+        try:
+            pieces = finish_pieces(task, url, decrypt_pieces(raw))
+        except InvalidSegment as e:
+            conditional = None
+            time.sleep(_retry_or_raise(task, url, e, attempt, started))
+            continue
+        if get_segment_cache():
+            get_segment_cache().store(task, raw, validators)
+        return pieces
+
+async def fetch_segment_async(session, task, url):
+    pieces, cached, conditional = cached_pieces(task, url)
+    if pieces is not None:
+        return pieces
+    for attempt in range(retry_attempts + 1):
+        if attempt:
+            url = mirror_pool.pick(task.url, avoid=host_of(url))
+        started = time.monotonic()
+        try:
+            status, data, validators = await fetch_hedged_async(session, task, url, conditional)
+            _record_success(task, url, status, data, started)
+            raw = split_parts(task, url, cached if status == 304 else data)
+        except Exception as e:
+            await asyncio.sleep(_retry_or_raise(task, url, e, attempt, started))
+            continue
+        try:
+            pieces = finish_pieces(task, url, await decrypt_pieces_async(raw))
+        except InvalidSegment as e:
+            conditional = None
+            await asyncio.sleep(_retry_or_raise(task, url, e, attempt, started))
+            continue
+        if get_segment_cache():
+            get_segment_cache().store(task, raw, validators)
+        return pieces
+
+async def _download_into_sink_async(session, task, url, sink):
+    for index, data in await fetch_segment_async(session, task, url):
+        (task.job or sink).put(index, data)
+
+# 逐个取出下载任务；直播模式下 tasks 是会阻塞等待刷新的生成器，放到线程里取，避免卡住事件循环
+async def _iterate_tasks(tasks):
+    if isinstance(tasks, list):
+        for task in tasks:
+            yield task
+        return
+    loop = asyncio.get_running_loop()
+    tasks = iter(tasks)
+    while (task := await loop.run_in_executor(None, next, tasks, None)) is not None:
+        yield task
+
+# 异步下载所有分片：每个主机的并发由 ConcurrencyController 控制，连接在分片之间复用
+async def download_all_ts_files_async(tasks, sink, limiter=None):
+    connector = aiohttp.TCPConnector(limit=max_workers * (2 if hedge_requests else 1), limit_per_host=0,
+                                     keepalive_timeout=keepalive_timeout)
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=request_timeout)
+    # 重排窗口：分片写出后才释放名额，保证缓存的分片数不超过 window
+    window = asyncio.Semaphore(sink.window) if sink.window else None
+    if window:
+        loop = asyncio.get_running_loop()
+
+        # 管道和转封装输出在写出线程里释放名额，交回事件循环执行；下载结束后还在写出的分片不用再释放
+        def release():
+            try:
+                loop.call_soon_threadsafe(window.release)
+            except RuntimeError:
+                pass
+
+        sink.on_flush = release
+    # 有任务结束或并发数变化时唤醒生产循环
+    changed = asyncio.Event()
+    running = [0]
+    failed = []
+
+    async def wait_until(ready):
+        while not ready():
+            changed.clear()
+            await changed.wait()
+
+    def on_done(job, task, controller):
+        controller.in_flight -= 1
+        running[0] -= 1
+        changed.set()
+        if not job.cancelled() and job.exception():
+            if task.job:
+                sink.fail(task.job, job.exception())  # 批量模式下只让所属任务失败
+                return
+            failed.append(job)
+            if window:
+                # 失败的分片永远不会写出，释放名额让生产循环能退出
+                for _ in range(task.count):
+                    window.release()
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        jobs = []
+        async for task in _iterate_tasks(tasks):
+            task.limiter = task.limiter or limiter
+            if window:
+                # 合并请求的任务包含几个分片就占几个名额
+                for _ in range(task.count):
+                    await window.acquire()
+            # 先选镜像，并发限制按实际请求的主机计算
+            url = mirror_pool.pick(task.url)
+            controller = get_controller(host_of(url))
+            await wait_until(lambda: failed or (running[0] < max_workers
+                                                and controller.in_flight < controller.level))
+            if failed:
+                break
+            controller.in_flight += 1
+            running[0] += 1
+            job = asyncio.create_task(_download_into_sink_async(session, task, url, sink))
+            job.add_done_callback(lambda job, task=task, controller=controller: on_done(job, task, controller))
+            jobs.append(job)
+        # 批量模式中失败的分片已经记到所属任务上，这里只抛出单个下载的失败
+        await asyncio.gather(*jobs, return_exceptions=True)
+        if failed:
+            failed[0].result()
+
+# 线程池下载所有分片
+def download_all_ts_files_threaded(tasks, sink, limiter=None):
+    window = threading.Semaphore(sink.window) if sink.window else None
+    if window:
+        sink.on_flush = window.release
+
+    def worker(task, url):
+        for index, data in fetch_segment(task, url):
+            (task.job or sink).put(index, data)
+
+    # 有任务结束或并发数变化时唤醒生产循环
+    changed = threading.Condition()
+    running = [0]
+    failed = []
+
+    def on_done(future, task, controller):
+        with changed:
+            controller.in_flight -= 1
+            running[0] -= 1
+            if not future.cancelled() and future.exception():
+                if task.job:
+                    sink.fail(task.job, future.exception())
+                else:
+                    failed.append(future)
+                    if window:
+                        window.release(task.count)
+            changed.notify_all()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
-        for i, segment in enumerate(m3u8_obj.segments):
-            ts_url = segment.uri
-            output_file = os.path.join(output_folder, f"test{i:011}.ts")
-            futures.append(executor.submit(download_ts_file, ts_url, output_file))
+        for task in tasks:
+            task.limiter = task.limiter or limiter
+            if window:
+                for _ in range(task.count):
+                    window.acquire()
+            url = mirror_pool.pick(task.url)
+            controller = get_controller(host_of(url))
+            with changed:
+                changed.wait_for(lambda: failed or (running[0] < max_workers
+                                                    and controller.in_flight < controller.level))
+                if failed:
+                    break
+                controller.in_flight += 1
+                running[0] += 1
+            future = executor.submit(worker, task, url)
+            future.add_done_callback(lambda future, task=task, controller=controller: on_done(future, task, controller))
+            futures.append(future)
+
+        wait(futures)  # 等待所有任务完成
+        if failed:
+            failed[0].result()  # 抛出失败分片的异常
+
+# 解析 EXT-X-BYTERANGE "长度[@偏移]"，返回 (偏移, 长度)，没有时返回 None；
+# 省略偏移时紧接同一文件的上一段，ends 记录每个文件上一段的结束位置
+def segment_byterange(segment, url, ends):
+    if not segment.byterange:
+        return None
+    length, _, offset = segment.byterange.partition("@")
+    offset = int(offset) if offset else ends.get(url, 0)
+    ends[url] = offset + int(length)
+    return offset, int(length)
+
+# 解析 clip_start/clip_end：数字和 "HH:MM:SS" 换算成秒，其余按 ISO 8601 时间解析
+def parse_clip_time(value):
+    if value is None or isinstance(value, (int, float, datetime.datetime)):
+        return value
+    value = value.strip()
+    if value.replace(":", "").replace(".", "", 1).isdigit():
+        return sum(float(part) * 60 ** i for i, part in enumerate(reversed(value.split(":"))))
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+# 分片时间索引：starts[i] 是第 i 个分片开始的时刻（秒，播放列表开头为 0），由 EXTINF 时长累加而成；
+# anchors 是带 EXT-X-PROGRAM-DATE-TIME 的分片 (时间戳, 序号)，绝对时间先换算到最近的锚点再查 starts
+class SegmentTimeline:
+    def __init__(self, segments):
+        self.starts = list(itertools.accumulate((segment.duration or 0 for segment in segments), initial=0))
+        self.anchors = [(segment.program_date_time.timestamp(), i)
+                        for i, segment in enumerate(segments) if segment.program_date_time]
+        self.tzinfo = self.anchors and segments[self.anchors[0][1]].program_date_time.tzinfo
+
+    # 把秒数或绝对时间换算成播放列表内的秒数
+    def offset(self, when):
+        if not isinstance(when, datetime.datetime):
+            return float(when)
+        if not self.anchors:
+            raise ValueError("播放列表没有 EXT-X-PROGRAM-DATE-TIME，不能按绝对时间剪辑")
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=self.tzinfo)
+        stamp = when.timestamp()
+        # 锚点之间可能因不连续而跳变，用起点不晚于该时刻的最后一个锚点；早于第一个锚点时向前推算
+        k = max(bisect.bisect_right(self.anchors, (stamp, float("inf"))) - 1, 0)
+        anchor, i = self.anchors[k]
+        offset = self.starts[i] + stamp - anchor
+        # 落在这段结束之后、下一个锚点之前的空档里时，归到下一个锚点的分片
+        if k + 1 < len(self.anchors):
+            offset = min(offset, self.starts[self.anchors[k + 1][1]])
+        return offset
+
+    # 覆盖 [start, end) 的分片序号范围 [first, last)
+    def span(self, start=None, end=None):
+        count = len(self.starts) - 1
+        first = 0 if start is None else max(bisect.bisect_right(self.starts, self.offset(start)) - 1, 0)
+        last = count if end is None else min(bisect.bisect_left(self.starts, self.offset(end)), count)
+        return min(first, count), max(last, first)
+
+# 按 clip_start/clip_end 选出要下载的分片范围，不剪辑时返回 None
+def clip_span(segments):
+    start, end = parse_clip_time(clip_start), parse_clip_time(clip_end)
+    if start is None and end is None:
+        return None
+    timeline = SegmentTimeline(segments)
+    first, last = timeline.span(start, end)
+    if first == last:
+        print("剪辑范围内没有分片")
+        return first, last
+    print(f"剪辑: 分片 {first}-{last - 1}（{last - first}/{len(segments)} 个，"
+          f"{timeline.starts[first]:.1f}-{timeline.starts[last]:.1f} 秒）")
+    return first, last
+
+# CUE-OUT 声明的插播时长（秒），没有或无法解析时返回 None
+def cue_duration(segment):
+    try:
+        return float(str(segment.scte35_duration).strip('"'))
+    except (TypeError, ValueError):
+        return None
+
+# 传给广告过滤规则的上下文
+class AdContext:
+    __slots__ = ("block", "duration", "in_cue")
+
+    def __init__(self, block):
+        self.block = block  # 分片所在的不连续段；直播跟随时段还没结束，为 None
+        self.duration = sum(segment.duration or 0 for segment in block) if block is not None else None
+        self.in_cue = False
+
+# 把 ad_filters 里的规则统一成 rule(segment, context) 的形式
+def ad_rule(rule):
+    if callable(rule):
+        return rule
+    if rule == "cue":
+        return lambda segment, context: context.in_cue
+    kind, *args = rule
+    if kind == "uri":
+        pattern = re.compile(args[0])
+        return lambda segment, context: pattern.search(absolute_uri(segment)) is not None
+    if kind == "duration":
+        return lambda segment, context: context.duration is not None and any(
+            abs(context.duration - float(d)) <= ad_duration_tolerance for d in args)
+    raise ValueError(f"不支持的广告过滤规则: {rule!r}")
+
+# 按 EXT-X-DISCONTINUITY 切分不连续段，同时按 CUE-OUT/CUE-IN 标出插播时段，每段产出 [(分片, 是否在插播时段内)]；
+# whole_blocks 为 False（直播跟随）时不等段结束，每个分片单独产出
+def cue_blocks(segments, whole_blocks=True):
+    block = []
+    in_cue, remaining = False, None
+    for segment in segments:
+        if segment.discontinuity and block:
+            yield block
+            block = []
+        if segment.cue_in:
+            in_cue, remaining = False, None
+        if segment.cue_out_start:
+            in_cue, remaining = True, cue_duration(segment)
+        elif segment.cue_out:
+            in_cue = True
+        block.append((segment, in_cue))
+        if in_cue and remaining is not None:
+            # 没有 CUE-IN 时按声明的时长结束插播
+            remaining -= segment.duration or 0
+            if remaining <= 0.01:
+                in_cue, remaining = False, None
+        if not whole_blocks:
+            yield block
+            block = []
+    if block:
+        yield block
+
+# 给每个分片标上是否按 ad_filters 跳过，产出 (分片, 是否跳过)
+def mark_ads(segments, live=False):
+    rules = [ad_rule(rule) for rule in ad_filters]
+    if not rules:
+        for segment in segments:
+            yield segment, False
+        return
+    for block in cue_blocks(segments, whole_blocks=not live):
+        context = AdContext(None if live else [segment for segment, _ in block])
+        for segment, in_cue in block:
+            context.in_cue = in_cue
+            yield segment, any(rule(segment, context) for rule in rules)
+
+# 按剪辑范围和广告过滤挑出要下载的分片，产出 (任务序号, 分片, 是否不连续点)，不下载的分片任务序号为 None；
+# 播放列表标了 EXT-X-DISCONTINUITY 的分片和去掉广告后接上的第一个分片都是不连续点，转封装时据此重新对齐时间轴
+def select_segments(segments, span=None, live=False):
+    first, last = span or (0, None)
+    index, cut, filtered = 0, False, 0
+    for i, (segment, skip) in enumerate(mark_ads(segments, live)):
+        if last is not None and i >= last:
+            break
+        if i < first or skip:
+            if i >= first:
+                filtered += 1
+                cut = True
+            yield None, segment, False
+            continue
+        yield index, segment, index > 0 and (cut or bool(segment.discontinuity))
+        index += 1
+        cut = False
+    if filtered:
+        print(f"广告过滤: 跳过 {filtered} 个分片")
+
+# 把播放列表分片转换成下载任务，跳过已完成的分片；
+# 同一文件里首尾相接的字节范围分片合并成一个任务（最多 max_parts 个分片、coalesce_max_bytes 字节）；
+# EXT-X-MAP 变化处的分片带上初始化分片，每个初始化分片只在切换到它时写一次；
+# span=(first, last) 时只处理这一段分片，剪辑和广告过滤后任务序号从 0 连续编号；
+# 不连续点的任务序号记入 boundaries；live（直播跟随）时不合并请求，广告过滤也不等整段
+def make_tasks(segments, done=(), partials=None, max_parts=None, live=False, span=None, boundaries=None):
+    partials = partials or {}
+    ends = {}
+    group = None
+    current_map = None
+    for i, segment, boundary in select_segments(segments, span, live):
+        url = absolute_uri(segment)
+        # 不下载的分片只用来推算省略偏移的字节范围
+        byterange = segment_byterange(segment, url, ends)
+        if i is None:
+            continue
+        if boundary and boundaries is not None:
+            boundaries.add(i)
+        # 已完成的分片也要参与比较：它们写出时已经带上了各自的初始化分片
+        seg_map, map_changed = segment_map(segment), False
+        if seg_map != current_map:
+            current_map, map_changed = seg_map, seg_map is not None
+        if i in done:
+            continue
+        key, iv = segment_key(segment)
+        init = init_cache.get(*seg_map) if map_changed else None
+        if group is not None:
+            if (byterange and not init and url == group.url and byterange[0] == sum(group.byterange)
+                    and group.count < (max_parts or float("inf"))
+                    and group.byterange[1] + byterange[1] <= coalesce_max_bytes):
+                group.merge(i, byterange, key, iv)
+                continue
+            yield group
+            group = None
+        if byterange and not live:
+            # 后面首尾相接的分片会并入这个任务
+            group = SegmentTask(i, url, b"", key, iv, byterange)
+            group.init = init
+            continue
+        # 磁盘上的半个分片已是明文，无法接着续传密文，加密分片只能整段重下；
+        # 字节范围分片和带初始化分片的分片也整段重下
+        partial = partials.get(i, b"") if key is None and byterange is None and init is None else b""
+        task = SegmentTask(i, url, partial, key, iv, byterange)
+        task.init = init
+        yield task
+    if group is not None:
+        yield group
+
+# 主播放列表中码率/分辨率不超过上限的候选，按码率从低到高排列；全部超限时保留最低的一个
+def variant_candidates(m3u8_obj):
+    variants = sorted(m3u8_obj.playlists, key=lambda v: v.stream_info.bandwidth or 0)
+    allowed = [v for v in variants
+               if (max_bandwidth is None or (v.stream_info.bandwidth or 0) <= max_bandwidth)
+               and (max_height is None or not v.stream_info.resolution
+                    or v.stream_info.resolution[1] <= max_height)]
+    return allowed or variants[:1]
+
+# 按 variant_policy 选定一个码率（"adaptive" 无法自适应时按 "best" 处理）
+def select_variant(m3u8_obj):
+    variants = variant_candidates(m3u8_obj)
+    variant = variants[0] if variant_policy == "worst" else variants[-1]
+    info = variant.stream_info
+    print(f"选择码率: {info.bandwidth} bps {info.resolution or ''} -> {variant.uri}")
+    return variant
+
+# 自适应码率：每到一个分片边界，按已完成分片的实测吞吐量估算剩余时间，
+# 选出能在期限内下完剩余部分的最高码率；各码率的分片需一一对齐
+class AdaptiveVariantSelector:
+    def __init__(self, variants, deadline=None):
+        self.variants = variants  # [(码率, 媒体播放列表)]，码率从低到高
+        self.deadline = deadline
+        self.current = 0
 
-        for future in as_completed(futures):
-            future.result()  # 等待所有任务完成并处理异常
+    def tasks(self, done=(), span=None, boundaries=None):
+        # 剪辑和广告过滤按第一个码率判断，各码率的分片一一对应；kept 是要下载的分片在播放列表里的位置
+        reference = self.variants[0][1].segments
+        kept = []
+        for position, (index, _, boundary) in enumerate(select_segments(reference, span)):
+            if index is None:
+                continue
+            kept.append(position)
+            if boundary and boundaries is not None:
+                boundaries.add(index)
+        durations = [reference[position].duration or 0 for position in kept]
+        remaining = sum(durations)
+        deadline = self.deadline or remaining
+        started = time.monotonic()
+        produced = []
+        # 各码率的字节范围单独计算；每个分片边界都可能切换码率，不合并请求
+        byteranges = []
+        for _, media in self.variants:
+            ends = {}
+            byteranges.append([segment_byterange(segment, absolute_uri(segment), ends) for segment in media.segments])
+        # 切换码率时初始化分片通常也跟着变，需要重新写出
+        current_map = None
+        for i, (position, duration) in enumerate(zip(kept, durations)):
+            if i in done:
+                remaining -= duration
+                continue
+            self.choose(produced, started, deadline, remaining)
+            segment = self.variants[self.current][1].segments[position]
+            key, iv = segment_key(segment)
+            task = SegmentTask(i, absolute_uri(segment), b"", key, iv, byteranges[self.current][position])
+            seg_map = segment_map(segment)
+            if seg_map != current_map:
+                current_map = seg_map
+                task.init = init_cache.get(*seg_map) if seg_map else None
+            produced.append(task)
+            yield task
+            remaining -= duration
 
-# 合并所有TS文件为一个MP4文件
-def merge_ts_files(output_mp4_file):
+    def choose(self, produced, started, deadline, remaining):
+        finished = [task.size for task in produced if task.size is not None]
+        elapsed = time.monotonic() - started
+        if not finished or elapsed <= 0:
+            return
+        throughput = sum(finished) / elapsed * adaptive_safety
+        budget = throughput * max(deadline - elapsed, 1e-3)
+        best = 0
+        for level, (bandwidth, _) in enumerate(self.variants):
+            if bandwidth / 8 * remaining <= budget:
+                best = level
+        if best != self.current:
+            print(f"切换码率: {self.variants[self.current][0]} -> {self.variants[best][0]} bps"
+                  f"（实测 {throughput * 8 / 1e6:.1f} Mbps）")
+            self.current = best
+
+# 自适应模式：加载所有候选码率的媒体播放列表，分片数不一致时返回 None 退回固定选择
+def adaptive_selector(m3u8_obj):
+    variants = [(v.stream_info.bandwidth or 0, load_playlist(absolute_uri(v)))
+                for v in variant_candidates(m3u8_obj)]
+    if len({len(media.segments) for _, media in variants}) != 1:
+        print("各码率的分片数不一致，无法自适应切换，改用最高码率")
+        return None
+    return AdaptiveVariantSelector(variants, adaptive_deadline)
+
+# 读取播放列表并生成下载任务（选码率、直播跟随、断点续传都在这里处理）；
+# lazy 时精简解析的播放列表边解析边产出任务，否则返回完整的任务列表
+def prepare_tasks(m3u8_file, sink, follow=None, lazy=False):
+    # 读取m3u8文件内容（本地文件或网络地址）
+    m3u8_obj = load_playlist(m3u8_file)
+
+    follow = follow_live if follow is None else follow
+    selector = None
+    if m3u8_obj.is_variant:
+        # 主播放列表本身没有分片，先选码率再加载对应的媒体播放列表
+        if variant_policy == "adaptive" and not follow:
+            selector = adaptive_selector(m3u8_obj)
+        if selector is None:
+            m3u8_file = absolute_uri(select_variant(m3u8_obj))
+            m3u8_obj = load_playlist(m3u8_file)
+
+    if follow and not m3u8_obj.is_endlist:
+        # 直播模式边刷新边下载；分片序号按出现顺序连续编号
+        # 等下一次刷新才能知道后面的分片能否合并，直播不合并请求，避免推迟最新分片
+        if clip_start is not None or clip_end is not None:
+            print("直播跟随模式不支持剪辑，忽略 clip_start/clip_end")
+        tasks = make_tasks(follow_playlist(m3u8_file, m3u8_obj), live=True, boundaries=sink.discontinuities)
+    else:
+        # 剪辑：在分片时间索引上二分查找，只为覆盖该时间段的分片生成任务；
+        # 不剪辑时不碰 segments，精简解析的播放列表才能边解析边下载
+        span = None
+        if clip_start is not None or clip_end is not None:
+            span = clip_span(selector.variants[0][1].segments if selector else m3u8_obj.segments)
+        # 断点续传：跳过已完成的分片，写了一半的分片带上已有内容继续下载
+        done, partials = sink.resume()
+        if done:
+            print(f"断点续传: 跳过 {len(done)} 个已完成的分片")
+        if selector:
+            # 半个分片不一定属于切换后的码率，自适应模式只跳过已完成的分片
+            tasks = selector.tasks(done, span, sink.discontinuities)
+        else:
+            # 合并的分片数不超过重排窗口的四分之一，窗口里同时能有几个请求在下载
+            max_parts = max(1, sink.window // 4) if sink.window else None
+            if lazy and span is None and not ad_filters and isinstance(m3u8_obj, LeanPlaylist):
+                # 不等整个播放列表解析完，前几个分片一解析出来就开始下载
+                metrics.expect(m3u8_obj.count - len(done))
+                tasks = make_tasks(m3u8_obj.iter_segments(), done, partials, max_parts,
+                                   boundaries=sink.discontinuities)
+            else:
+                tasks = list(make_tasks(m3u8_obj.segments, done, partials, max_parts, span=span,
+                                        boundaries=sink.discontinuities))
+    return tasks
+
+# 用选定的下载引擎下载 tasks，分片交给 sink
+def run_downloads(tasks, sink, engine=None, limiter=None):
+    engine = engine or download_engine
+    get_segment_cache()  # 在主线程里打开缓存，下载线程共用同一个
+    if engine == "async" and aiohttp is None:
+        print("未安装 aiohttp，改用线程池模式下载")
+        engine = "thread"
+
+    if engine == "async":
+        asyncio.run(download_all_ts_files_async(tasks, sink, limiter))
+    else:
+        download_all_ts_files_threaded(tasks, sink, limiter)
+
+# 下载并保存所有TS文件，sink 决定分片写到哪里（默认写入 ts_files 文件夹）
+def download_all_ts_files(m3u8_file, engine=None, sink=None, follow=None):
+    sink = sink or TsFolderSink()
+    download_tasks(prepare_tasks(m3u8_file, sink, follow, lazy=True), sink, engine)
+
+# 下载已生成的任务，单个下载任务有自己的限速器
+def download_tasks(tasks, sink, engine=None):
+    if isinstance(tasks, list):
+        metrics.expect(sum(task.count for task in tasks))
+    limiter = RateLimiter(job_rate_limit)
+    _job_limiters.add(limiter)
+    try:
+        run_downloads(tasks, sink, engine, limiter)
+    finally:
+        _job_limiters.discard(limiter)
+
+# 批量模式中的一个下载任务：自己的输出文件、断点续传日志和限速器，分片完成情况单独统计
+class DownloadJob:
+    def __init__(self, m3u8_file, output_file, priority=1):
+        self.m3u8_file = m3u8_file
+        self.output_file = output_file
+        self.priority = max(priority, 1e-3)
+        remux = should_remux(output_file)
+        # 管道无法回头校验，不能按日志续传；转封装输出和单个任务一样，打开 resume_remux 时先写 TS 暂存文件
+        resume = resume_downloads and not is_pipe_output(output_file)
+        self.staging = remux and resume and resume_remux
+        self.journal = DownloadJournal(output_file + ".journal") if resume and (not remux or self.staging) else None
+        self.sink = ReorderBuffer(staged_file(output_file) if self.staging else output_file,
+                                  journal=self.journal, remux=remux and not self.staging)
+        self.limiter = RateLimiter(job_rate_limit)
+        self.tasks = None
+        self.exhausted = False
+        self.closed = False
+        self.error = None
+        self.scheduled = 0
+        self.finished = 0
+        self.bytes = 0
+        self.outstanding = 0  # 已调度、还没写出的分片数，受重排窗口限制
+        self.started = time.monotonic()
+        self.ended = None
+        self.lock = threading.Lock()
+
+    @property
+    def status(self):
+        if self.error:
+            return "失败"
+        return "完成" if self.closed else "进行中"
+
+    def put(self, index, data):
+        self.sink.put(index, data)
+        with self.lock:
+            self.finished += 1
+            self.bytes += len(data)
+        self.check_done()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+            print(f"任务失败: {self.output_file}（{error}）")
+
+    # 所有分片都已调度并写出时关闭输出文件
+    def check_done(self):
+        with self.lock:
+            if self.closed or not self.exhausted or self.finished < self.scheduled:
+                return
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.ended = time.monotonic()
+        self.sink.close()
+        if self.staging and not self.error and not self.sink.pending:
+            remux_staged_file(self.output_file, self.journal, self.sink.discontinuities)
+        if self.journal:
+            # 失败的任务保留日志，下次运行可以续传
+            self.journal.close(remove=not self.error and not self.sink.pending)
+        if not self.error:
+            print(f"任务完成: {self.output_file}（{self.finished} 个分片，{self.bytes / 1e6:.1f} MB，"
+                  f"{self.ended - self.started:.1f} 秒）")
+
+# 批量调度：把所有任务的分片合并成一个任务流，共用同一套下载名额和连接；
+# 每次从还有重排窗口余量的任务里挑一个：fair 按 已调度数/优先级 最小，priority 按优先级最高
+class BatchScheduler:
+    window = None
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.changed = threading.Condition()
+
+    def _on_flush(self, job):
+        with self.changed:
+            job.outstanding -= 1
+            self.changed.notify_all()
+
+    # 任务失败：失败的分片永远不会写出，窗口名额不会再释放，要叫醒等在窗口上的调度循环
+    def fail(self, job, error):
+        with self.changed:
+            job.fail(error)
+            self.changed.notify_all()
+
+    def _pick(self, ready):
+        if batch_policy == "priority":
+            return max(ready, key=lambda job: (job.priority, -job.scheduled))
+        return min(ready, key=lambda job: job.scheduled / job.priority)
+
+    def tasks(self):
+        active = [job for job in self.jobs if job.tasks is not None]
+        while active:
+            with self.changed:
+                self.changed.wait_for(lambda: any(job.error or job.outstanding < job.sink.window
+                                                  for job in active))
+                active = [job for job in active if not job.error]
+                ready = [job for job in active if job.outstanding < job.sink.window]
+            if not ready:
+                continue
+            job = self._pick(ready)
+            task = next(job.tasks, None)
+            if task is None:
+                active.remove(job)
+                job.exhausted = True
+                job.check_done()
+                continue
+            task.job = job
+            task.limiter = job.limiter
+            with self.changed:
+                job.scheduled += task.count
+                job.outstanding += task.count
+            yield task
+
+    def run(self, engine=None):
+        for job in self.jobs:
+            job.sink.on_flush = lambda job=job: self._on_flush(job)
+            _job_limiters.add(job.limiter)
+            try:
+                tasks = prepare_tasks(job.m3u8_file, job.sink, follow=False)
+                if isinstance(tasks, list):
+                    metrics.expect(sum(task.count for task in tasks))
+                job.tasks = iter(tasks)
+            except Exception as e:
+                job.fail(e)
+        try:
+            run_downloads(self.tasks(), self, engine)
+        finally:
+            # 失败或被中断的任务在所有分片结束后再关闭
+            for job in self.jobs:
+                _job_limiters.discard(job.limiter)
+                if not job.closed:
+                    job.fail(job.error or RuntimeError("下载中断"))
+                    job.close()
+
+# 读取批量任务文件：每行一个任务，JSONL 格式 {"m3u8": ..., "output": ..., "priority": 1}，
+# 或者用空白分隔的 "m3u8 输出文件 [优先级]"；空行和 # 开头的行忽略
+def load_jobs(job_file):
+    jobs = []
+    with open(job_file, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                jobs.append(DownloadJob(item["m3u8"], item["output"], float(item.get("priority", 1))))
+            else:
+                parts = line.split()
+                jobs.append(DownloadJob(parts[0], parts[1], float(parts[2]) if len(parts) > 2 else 1))
+    return jobs
+
+# 批量模式入口：所有任务共用下载名额、连接池和并发控制，结束后逐个报告结果
+def batch_main(job_file, engine=None):
+    jobs = load_jobs(job_file)
+    metrics.start()
+    start_metrics_server()
+    BatchScheduler(jobs).run(engine)
+    report_metrics()
+    print("批量下载结果:")
+    for job in jobs:
+        elapsed = (job.ended or time.monotonic()) - job.started
+        print(f"  [{job.status}] {job.output_file}: {job.finished} 个分片，{job.bytes / 1e6:.1f} MB，{elapsed:.1f} 秒"
+              + (f"，错误: {job.error}" if job.error else ""))
+    return jobs
+
+# 内核拷贝不被当前文件系统支持时记下来，后面的分片直接走缓冲区拷贝
+_kernel_copy_unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+_kernel_copy = hasattr(os, "copy_file_range") or hasattr(os, "sendfile")
+
+# 在内核里把 src 的 size 字节追加到 dst（copy_file_range，其次 sendfile），数据不经过用户态；
+# 返回已拷贝的字节数
+def kernel_copy(src_fd, dst_fd, size):
+    global _kernel_copy
+    copied = 0
+    try:
+        while copied < size:
+            if hasattr(os, "copy_file_range"):
+                n = os.copy_file_range(src_fd, dst_fd, size - copied, copied)
+            else:
+                n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+            if n == 0:
+                break
+            copied += n
+    except OSError as e:
+        if copied or e.errno not in _kernel_copy_unsupported:
+            raise
+        _kernel_copy = False
+    return copied
+
+# 把一个分片文件追加到输出文件末尾
+def append_ts_file(dst, ts_path, buffer):
+    with open(ts_path, 'rb', buffering=0) as ts:
+        size = os.fstat(ts.fileno()).st_size
+        copied = kernel_copy(ts.fileno(), dst.fileno(), size) if _kernel_copy else 0
+        if copied < size:
+            # 回退：用固定大小的缓冲区 readinto，不为每个分片分配整块内存
+            ts.seek(copied)
+            view = memoryview(buffer)
+            while (n := ts.readinto(buffer)):
+                dst.write(view[:n])
+
+# 按顺序把分片文件喂给转封装器，写出分片 MP4
+def remux_ts_files(output_mp4_file, ts_files, discontinuities=()):
     with open(output_mp4_file, 'wb') as f:
-        for ts_file in sorted(os.listdir(output_folder)):
-            ts_path = os.path.join(output_folder, ts_file)
+        remuxer = ts_remux.TsToFmp4(f)
+        for index, ts_path in ts_files:
+            if index in discontinuities:
+                remuxer.discontinuity()
             with open(ts_path, 'rb') as ts:
-                f.write(ts.read())
+                remuxer.write(ts.read())
+        remuxer.close()
+
+# 需要续传的转封装输出先写到这个 TS 暂存文件
+def staged_file(output_file):
+    return output_file + ".ts"
+
+# 把暂存文件转封装成输出文件：按日志里各分片的长度切开，在不连续点通知转封装器，完成后删除暂存文件
+def remux_staged_file(output_file, journal, discontinuities=()):
+    with open(staged_file(output_file), 'rb') as ts, open(output_file, 'wb') as f:
+        remuxer = ts_remux.TsToFmp4(f)
+        for index in sorted(journal.entries):
+            data = ts.read(journal.entries[index][0])
+            if not data:
+                break
+            if index in discontinuities:
+                remuxer.discontinuity()
+            remuxer.write(data)
+        remuxer.close()
+    os.remove(staged_file(output_file))
+
+# 合并所有TS文件为一个MP4文件，按分片序号（而不是文件名字符串）排序；indices 给出时只合并这些分片
+def merge_ts_files(output_mp4_file, remux=False, discontinuities=(), indices=None):
+    ts_files = [(ts_file_index(name), name) for name in os.listdir(output_folder)]
+    if indices is not None:
+        ts_files = [item for item in ts_files if item[0] in indices]
+    if remux:
+        ts_paths = [(index, os.path.join(output_folder, ts_file))
+                    for index, ts_file in sorted(item for item in ts_files if item[0] is not None)]
+        remux_ts_files(output_mp4_file, ts_paths, discontinuities)
+        return
+    buffer = bytearray(merge_buffer_size)
+    # 不带缓冲打开，内核拷贝和 write 共用同一个文件位置
+    with open(output_mp4_file, 'wb', buffering=0) as f:
+        for _, ts_file in sorted(item for item in ts_files if item[0] is not None):
+            append_ts_file(f, os.path.join(output_folder, ts_file), buffer)
 
 # 删除所有TS文件
 def delete_ts_files():
@@ -49,13 +2845,79 @@ def delete_ts_files():
     os.rmdir(output_folder)
 
 # 主函数
-def main(m3u8_file, output_mp4_file):
-    download_all_ts_files(m3u8_file)
-    merge_ts_files(output_mp4_file)
-    delete_ts_files()
-    print(f"所有TS文件已合并成: {output_mp4_file}，并已删除所有TS文件")
+# output_mp4_file 为 "-" 时写到标准输出，也可以是命名管道，边下载边按顺序输出
+def main(m3u8_file, output_mp4_file, engine=None, mode=None, resume=None, follow=None):
+    metrics.default_job = output_mp4_file
+    metrics.start()
+    # 输出到标准输出时，进度和提示信息改写到标准错误，不混进视频数据
+    stdout = sys.stdout
+    if output_mp4_file == "-":
+        sys.stdout = sys.stderr
+    start_metrics_server()
+    try:
+        mode = mode or merge_mode
+        follow = follow_live if follow is None else follow
+        # 直播的分片序号随刷新窗口变化，日志无法对应，跟随模式下不做断点续传
+        remux = should_remux(output_mp4_file)
+        resume = (resume_downloads if resume is None else resume) and not follow
+        if is_pipe_output(output_mp4_file):
+            mode, resume = "stream", False
+        if remux and mode == "preallocate":
+            mode = "stream"  # 转封装后的大小无法预先确定
+        # 边下载边转封装无法续传，打开 resume_remux 时先写 TS 暂存文件
+        staging = remux and mode == "stream" and resume and resume_remux
+        if remux and mode == "stream" and not staging:
+            resume = False
+        journal = DownloadJournal(output_mp4_file + ".journal") if resume else None
+        if mode == "preallocate":
+            sink = PositionalSink(output_mp4_file, journal=journal)
+            try:
+                tasks = prepare_tasks(m3u8_file, sink, follow)
+                done = sink.layout(tasks) if isinstance(tasks, list) else None
+                if done is not None:
+                    if done:
+                        print(f"断点续传: 跳过 {len(done)} 个已完成的分片")
+                    download_tasks([task for task in tasks if not done.issuperset(task.indices)], sink, engine)
+            finally:
+                sink.close()
+            if done is not None:
+                if journal:
+                    journal.close(remove=not sink.pending)
+                print(f"所有TS分片已写入预分配的输出文件: {output_mp4_file}")
+                return
+            print("分片大小无法预先确定，改用按顺序写入")
+            mode = "stream"
+        if mode == "stream":
+            # 边下载边按顺序写入，不产生临时文件
+            sink = ReorderBuffer(staged_file(output_mp4_file) if staging else output_mp4_file,
+                                 journal=journal, remux=remux and not staging)
+            try:
+                download_all_ts_files(m3u8_file, engine, sink, follow)
+            finally:
+                sink.close()
+            if staging and not sink.pending:
+                remux_staged_file(output_mp4_file, journal, sink.discontinuities)
+            if journal:
+                journal.close(remove=not sink.pending)
+            print(f"所有TS分片已按顺序写入: {output_mp4_file}")
+            return
+
+        sink = TsFolderSink(journal=journal)
+        download_all_ts_files(m3u8_file, engine, sink, follow)
+        merge_ts_files(output_mp4_file, remux, sink.discontinuities, sink.indices)
+        delete_ts_files()
+        if journal:
+            journal.close(remove=True)
+        print(f"所有TS文件已合并成: {output_mp4_file}，并已删除所有TS文件")
+    finally:
+        report_metrics()
+        sys.stdout = stdout
 
 if __name__ == "__main__":
     m3u8_file = "test.m3u8"  # 替换为你的本地m3u8文件名
     output_mp4_file = "output_videos.mp4"
-    main(m3u8_file, output_mp4_file)
+    batch_file = None  # 批量模式：任务列表文件（每行 "m3u8 输出文件 [优先级]" 或 JSONL），设置后忽略上面两项
+    if batch_file:
+        batch_main(batch_file)
+    else:
+        main(m3u8_file, output_mp4_file)
@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import http.server
+import importlib.util
+
+try:
+    from Crypto.Cipher import AES  # 需安装: pip install pycryptodome（没有时跳过加密场景）
+except ImportError:
+    AES = None
+
+# m3u8.py 的下载性能基准：在本机起一个 HTTP 服务器，按场景生成播放列表和分片（可注入延迟、错误、限速，
+# 以及字节范围和 AES-128 加密的变体），在子进程里端到端跑一遍下载，
+# 把分片/秒、MB/秒、峰值内存和 CPU 时间追加到结果文件，方便比较前后两次改动；全程不需要外网
+
+# 被测的下载脚本
+downloader_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "m3u8.py")
+# 结果文件：每次运行每个场景追加一行 JSON
+results_file = "bench_results.jsonl"
+# 默认的分片数和分片大小（字节，会取整到 188 的倍数）
+segment_count = 200
+segment_size = 1024 * 1024
+# 错误注入和随机延迟使用固定种子，保证每次运行的请求序列相同
+random_seed = 1234
+
+# 场景：在默认参数上覆盖的部分
+# latency: 每个请求的首字节延迟（秒），errors: 返回 503 的比例，throttle: 每个连接的限速（字节/秒），
+# variant: "plain"、"byterange"（所有分片切自同一个文件）或 "encrypted"（AES-128）
+scenarios = {
+    "plain": {},
+    "latency": {"latency": 0.05},
+    "errors": {"errors": 0.05},
+    "throttled": {"throttle": 4 * 1024 * 1024},
+    "byterange": {"variant": "byterange"},
+    "encrypted": {"variant": "encrypted"},
+}
+
+KEY = bytes(range(16))
+IV = bytes(16)
+
+# 生成一个合法的 MPEG-TS 分片：单个 PID，连续计数器逐包递增，负载是固定的伪随机字节
+def make_segment(size):
+    packets = max(size // 188, 1)
+    payload = random.Random(random_seed).randbytes(184)
+    return b"".join(bytes((0x47, 0x41 if i == 0 else 0x01, 0x00, 0x10 | (i & 0x0F))) + payload
+                    for i in range(packets))
+
+# AES-128-CBC 加 PKCS7 填充，所有分片用同一个显式 IV，只需加密一次
+def encrypt_segment(data):
+    pad = 16 - len(data) % 16
+    return AES.new(KEY, AES.MODE_CBC, IV).encrypt(data + bytes([pad]) * pad)
+
+# 按场景生成播放列表和分片内容，由 BenchServer 提供下载
+class SyntheticHls:
+    def __init__(self, count, size, variant="plain", latency=0, errors=0, throttle=None):
+        self.count = count
+        self.variant = variant
+        self.latency = latency
+        self.errors = errors
+        self.throttle = throttle
+        self.segment = make_segment(size)
+        self.expected = len(self.segment) * count  # 下载完整时输出文件的大小
+        if variant == "encrypted":
+            self.segment = encrypt_segment(self.segment)
+        self.random = random.Random(random_seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.injected = 0
+
+    def playlist(self, base):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:4", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+        if self.variant == "encrypted":
+            lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="{base}/key",IV=0x{IV.hex()}')
+        for i in range(self.count):
+            lines.append("#EXTINF:4.0,")
+            if self.variant == "byterange":
+                lines.append(f"#EXT-X-BYTERANGE:{len(self.segment)}@{i * len(self.segment)}")
+                lines.append(f"{base}/all.ts")
+            else:
+                lines.append(f"{base}/seg/{i}.ts")
+        lines.append("#EXT-X-ENDLIST")
+        return ("\n".join(lines) + "\n").encode()
+
+    # 字节范围变体的大文件就是同一个分片重复 count 次，按需截取，不占用整块内存
+    def file_slice(self, start, end):
+        size = len(self.segment)
+        chunks = []
+        while start < end:
+            offset = start % size
+            n = min(size - offset, end - start)
+            chunks.append(self.segment[offset:offset + n])
+            start += n
+        return b"".join(chunks)
+
+    def file_size(self, path):
+        if path == "/all.ts":
+            return len(self.segment) * self.count
+        return len(self.segment)
+
+    # 按错误比例决定这次请求是否返回 503
+    def inject_error(self):
+        with self.lock:
+            self.requests += 1
+            if self.errors and self.random.random() < self.errors:
+                self.injected += 1
+                return True
+            return False
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    # HEAD 只返回头部（preallocate 模式用它预先取得分片大小），不注入延迟和错误
+    def do_HEAD(self):
+        path = self.path.split("?")[0]
+        if path != "/all.ts" and not (path.startswith("/seg/") and path.endswith(".ts")):
+            return self.reply(404, b"")
+        self.send_response(200)
+        self.send_header("Content-Length", str(self.server.hls.file_size(path)))
+        self.end_headers()
+
+    def do_GET(self):
+        hls = self.server.hls
+        path = self.path.split("?")[0]
+        if path == "/index.m3u8":
+            return self.reply(200, hls.playlist(f"http://127.0.0.1:{self.server.server_address[1]}"))
+        if path == "/key":
+            return self.reply(200, KEY)
+        if path != "/all.ts" and not (path.startswith("/seg/") and path.endswith(".ts")):
+            return self.reply(404, b"")
+        if hls.latency:
+            time.sleep(hls.latency)
+        if hls.inject_error():
+            return self.reply(503, b"", {"Retry-After": "0"})
+        total = hls.file_size(path)
+        start, end, status, headers = 0, total, 200, {}
+        header = self.headers.get("Range")
+        if header and header.startswith("bytes="):
+            first, _, last = header[6:].partition("-")
+            start = int(first)
+            end = min(int(last) + 1, total) if last else total
+            if start >= total:
+                return self.reply(416, b"", {"Content-Range": f"bytes */{total}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{total}"
+        body = hls.file_slice(start, end) if path == "/all.ts" else hls.segment[start:end]
+        self.reply(status, body, headers)
+
+    # 限速时按 64 KiB 一块写出，每块之后补足到目标速率
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        throttle = self.server.hls.throttle
+        if not throttle:
+            self.wfile.write(body)
+            return
+        started, view = time.monotonic(), memoryview(body)
+        for offset in range(0, len(body), 65536):
+            self.wfile.write(view[offset:offset + 65536])
+            delay = (offset + 65536) / throttle - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+class BenchServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # 默认的 5 在高并发下会让连接排队重试，测出的是监听队列而不是下载器
+
+    def __init__(self, hls):
+        super().__init__(("127.0.0.1", 0), BenchHandler)
+        self.hls = hls
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/index.m3u8"
+
+# 加载被测的下载脚本：它和 m3u8 库同名，先导入真正的库，再用别的模块名加载脚本
+def load_downloader(path):
+    script_dir = os.path.dirname(os.path.abspath(path))
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or ".") != script_dir]
+    import m3u8  # noqa: F401  真正的 m3u8 库
+    sys.path.append(script_dir)  # 脚本同目录的 ts_remux 等模块
+    spec = importlib.util.spec_from_file_location("m3u8_downloader", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["m3u8_downloader"] = module  # 进程池解密时按模块名找回函数
+    spec.loader.exec_module(module)
+    return module
+
+# 子进程：对给定的播放列表跑一次完整下载，把耗时和资源占用写到 result_path
+def run_child(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    downloader = load_downloader(config["downloader"])
+    for name, value in config["settings"].items():
+        setattr(downloader, name, value)
+    output = os.path.join(config["workdir"], "out.ts")
+    os.chdir(config["workdir"])
+    started = time.perf_counter()
+    downloader.main(config["url"], output, engine=config["engine"], mode=config["mode"], resume=False)
+    wall = time.perf_counter() - started
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = {
+        "wall": wall,
+        "bytes": os.path.getsize(output),
+        "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "peak_rss_mb": max(own.ru_maxrss, children.ru_maxrss) / 1024,  # Linux 下 ru_maxrss 的单位是 KiB
+    }
+    with open(config["result"], "w") as f:
+        json.dump(result, f)
+
+# 当前代码的版本，方便结果文件里区分不同的改动；没有 git 时为空
+def code_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(downloader_path), timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+# 跑一个场景：起服务器，在子进程里下载，返回一条结果记录
+def run_scenario(name, params, count, size, engine, mode, settings, verbose=False):
+    hls = SyntheticHls(count, size, **params)
+    server = BenchServer(hls)
+    try:
+        with tempfile.TemporaryDirectory(prefix="m3u8_bench_") as workdir:
+            config = {"downloader": downloader_path, "url": server.url, "engine": engine, "mode": mode,
+                      "settings": settings, "workdir": workdir, "result": os.path.join(workdir, "result.json")}
+            config_path = os.path.join(workdir, "config.json")
+            with open(config_path, "w") as f:
+                json.dump(config, f)
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--child", config_path], check=True,
+                           stdout=None if verbose else subprocess.DEVNULL)
+            with open(config["result"]) as f:
+                result = json.load(f)
+    finally:
+        server.shutdown()
+        server.server_close()
+    mb = result["bytes"] / 1e6
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": code_revision(),
+        "scenario": name,
+        "params": params,
+        "engine": engine,
+        "mode": mode,
+        "segments": count,
+        "segment_size": len(hls.segment),
+        "complete": result["bytes"] == hls.expected,
+        "requests": hls.requests,
+        "injected_errors": hls.injected,
+        "wall_s": round(result["wall"], 3),
+        "segments_per_s": round(count / result["wall"], 1),
+        "mb_per_s": round(mb / result["wall"], 1),
+        "peak_rss_mb": round(result["peak_rss_mb"], 1),
+        "cpu_s": round(result["cpu"], 3),
+        "cpu_s_per_gb": round(result["cpu"] / max(mb / 1000, 1e-9), 2),
+    }
+
+# 结果文件里同一场景、同一引擎的上一条记录
+def previous_result(path, record):
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path) as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if all(item.get(key) == record[key] for key in ("scenario", "engine", "mode", "segments", "segment_size")):
+                last = item
+    return last
+
+def print_result(record, previous):
+    line = (f"{record['scenario']:<10} {record['engine']:<6} {record['segments_per_s']:>8.1f} 分片/s "
+            f"{record['mb_per_s']:>8.1f} MB/s  峰值内存 {record['peak_rss_mb']:>7.1f} MB  "
+            f"CPU {record['cpu_s']:>6.2f} s（{record['cpu_s_per_gb']:.2f} s/GB）")
+    if not record["complete"]:
+        line += "  输出不完整!"
+    if previous:
+        change = lambda key: (record[key] / previous[key] - 1) * 100 if previous.get(key) else 0
+        line += (f"  对比 {previous.get('revision') or previous['time']}: MB/s {change('mb_per_s'):+.0f}%，"
+                 f"CPU/GB {change('cpu_s_per_gb'):+.0f}%")
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="m3u8.py 下载性能基准（本机合成 HLS 服务器，不需要外网）")
+    parser.add_argument("scenarios", nargs="*", default=list(scenarios), help=f"要跑的场景，默认全部: {', '.join(scenarios)}")
+    parser.add_argument("--segments", type=int, default=segment_count, help="分片数")
+    parser.add_argument("--size", type=int, default=segment_size, help="分片大小（字节）")
+    parser.add_argument("--engine", choices=("async", "thread"), action="append", help="下载引擎，可重复指定")
+    parser.add_argument("--mode", choices=("stream", "files", "preallocate"), default="stream", help="合并模式")
+    parser.add_argument("--repeat", type=int, default=1, help="每个场景重复次数")
+    parser.add_argument("--results", default=results_file, help="结果文件（JSONL，追加写入）")
+    parser.add_argument("--set", action="append", default=[], metavar="名字=JSON值",
+                        help="覆盖下载脚本的配置，例如 --set max_workers=16 --set validate_segments=false")
+    parser.add_argument("--verbose", action="store_true", help="显示下载脚本的输出")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child)
+        return
+
+    # 基准只关心下载本身：关掉进度行、断点续传日志，重试等待尽量短
+    settings = {"progress_interval": 3600, "retry_base_delay": 0.01, "resume_downloads": False}
+    for item in args.set:
+        name, _, value = item.partition("=")
+        settings[name] = json.loads(value)
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"未知场景: {name}")
+        if scenarios[name].get("variant") == "encrypted" and AES is None:
+            print(f"跳过 {name}: 未安装 pycryptodome")
+            continue
+        for engine in args.engine or ["async"]:
+            for _ in range(args.repeat):
+                record = run_scenario(name, scenarios[name], args.segments, args.size, engine, args.mode,
+                                      settings, args.verbose)
+                record["settings"] = settings
+                print_result(record, previous_result(args.results, record))
+                with open(args.results, "a") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    main()
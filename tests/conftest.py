@@ -0,0 +1,103 @@
+import os
+import sys
+import threading
+import importlib.util
+import http.server
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # ts_remux 和 m3u8_bench
+
+
+# 按文件路径加载下载脚本（模块名和 m3u8 库区分开），每个测试拿到一份独立的模块状态
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    spec = importlib.util.spec_from_file_location("m3u8_downloader", os.path.join(ROOT, "m3u8.py"))
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, "m3u8_downloader", module)
+    spec.loader.exec_module(module)
+    module.progress_interval = 3600
+    monkeypatch.chdir(tmp_path)
+    return module
+
+
+# 一个 MPEG-TS 分片：每个 188 字节的包都以同步字节开头
+def ts_segment(index, packets=20):
+    return (bytes([0x47, index % 256]) + bytes(186)) * packets
+
+
+# 本地 HTTP 服务：files 是 路径 -> 内容（也可以是每次请求调用一次的函数，返回 None 时回 503），
+# failing 里的路径一律返回 503；带 Range 的请求按字节范围返回
+class SegmentServer:
+    def __init__(self, files, failing=()):
+        self.files = files
+        self.failing = set(failing)
+        self.hits = []
+        self.ranges = []  # (路径, Range 请求头)
+        owner = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                owner.hits.append(self.path)
+                if self.headers.get("Range"):
+                    owner.ranges.append((self.path, self.headers["Range"]))
+                path = self.path.split("?")[0]
+                body = owner.files.get(path)
+                dynamic = callable(body)
+                if dynamic:
+                    body = body()
+                if path in owner.failing or body is None:
+                    self.send_response(503 if path in owner.failing or dynamic else 404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                # 支持 "Range: bytes=N-"，起点越界时按规范回 416 并给出总长度
+                offset = self.headers.get("Range", "bytes=0-")[6:].partition("-")[0]
+                if offset.isdigit() and int(offset) >= len(body) and self.headers.get("Range"):
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(body)}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if offset.isdigit() and int(offset):
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {offset}-{len(body) - 1}/{len(body)}")
+                    body = body[int(offset):]
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# count 个分片的 VOD 播放列表，返回 (服务, 播放列表地址)
+@pytest.fixture
+def hls_server():
+    servers = []
+
+    def start(count, failing=(), **playlist):
+        files = {f"/s{i}.ts": ts_segment(i) for i in range(count)}
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4"]
+        for i in range(count):
+            lines += ["#EXTINF:4.0,", f"s{i}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        files["/p.m3u8"] = ("\n".join(lines) + "\n").encode()
+        server = SegmentServer(files, failing)
+        servers.append(server)
+        return server, server.url + "/p.m3u8"
+
+    yield start
+    for server in servers:
+        server.close()
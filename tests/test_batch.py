@@ -0,0 +1,38 @@
+import threading
+
+import pytest
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_failed_job_with_full_window_does_not_hang(downloader, hls_server, engine):
+    # 分片 0 一直 503：重试期间后面的分片填满重排窗口，分片 0 最终失败后调度循环必须被叫醒
+    server, playlist = hls_server(40, failing={"/s0.ts"})
+    downloader.reorder_window = 4
+    downloader.retry_attempts = 2
+    downloader.retry_base_delay = 0.05
+    downloader.retry_max_delay = 0.1
+    job = downloader.DownloadJob(playlist, "out.ts")
+    finished = threading.Event()
+
+    def run():
+        downloader.BatchScheduler([job]).run(engine)
+        finished.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    assert finished.wait(30), "批量调度在任务失败后卡住"
+    assert job.status == "失败"
+    assert job.closed
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_one_failed_job_leaves_others_running(downloader, hls_server, engine):
+    server, playlist = hls_server(12, failing={"/s3.ts"})
+    _, good_playlist = hls_server(12)
+    downloader.reorder_window = 4
+    downloader.retry_attempts = 1
+    downloader.retry_base_delay = 0.05
+    jobs = [downloader.DownloadJob(playlist, "bad.ts"), downloader.DownloadJob(good_playlist, "good.ts")]
+    downloader.BatchScheduler(jobs).run(engine)
+    assert [job.status for job in jobs] == ["失败", "完成"]
+    with open("good.ts", "rb") as f:
+        assert len(f.read()) == 12 * 20 * 188
@@ -0,0 +1,73 @@
+import struct
+import threading
+
+import pytest
+
+from conftest import SegmentServer
+
+
+def box(kind, payload=b""):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+INIT = box(b"ftyp", b"isom" + bytes(4)) + box(b"moov", bytes(32))
+
+
+def fragment(index):
+    return box(b"moof", bytes([index]) * 16) + box(b"mdat", bytes([index]) * 64)
+
+
+# init.mp4 第一次返回 503：重试后拿到初始化分片，不会在下载任何媒体分片之前中止
+@pytest.mark.parametrize("byterange", [False, True])
+def test_init_section_retries_transient_errors(downloader, byterange):
+    requests = []
+    body = INIT + b"trailing bytes outside the range" if byterange else INIT
+
+    def init():
+        requests.append(1)
+        return None if len(requests) == 1 else body
+
+    tag = f'#EXT-X-MAP:URI="init.mp4",BYTERANGE="{len(INIT)}@0"' if byterange else '#EXT-X-MAP:URI="init.mp4"'
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-TARGETDURATION:4", tag]
+    for i in range(3):
+        lines += ["#EXTINF:4.0,", f"s{i}.m4s"]
+    lines.append("#EXT-X-ENDLIST")
+    files = {f"/s{i}.m4s": fragment(i) for i in range(3)}
+    files["/init.mp4"] = init
+    files["/p.m3u8"] = ("\n".join(lines) + "\n").encode()
+    server = SegmentServer(files)
+    try:
+        downloader.retry_base_delay = 0.01
+        downloader.main(server.url + "/p.m3u8", "out.m4s", engine="thread")
+    finally:
+        server.close()
+    assert len(requests) == 2
+    with open("out.m4s", "rb") as f:
+        assert f.read() == INIT + b"".join(fragment(i) for i in range(3))
+
+
+# 一个初始化分片下载卡住时，其他已缓存的初始化分片照常返回
+def test_slow_init_section_does_not_block_cached_sections(downloader, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def fetch(uri, byterange=None):
+        started.set()
+        release.wait(5)
+        return INIT
+
+    cache = downloader.InitSectionCache()
+    cache.sections["cached", None] = b"cached"
+    monkeypatch.setattr(downloader, "fetch_init_section", fetch)
+    slow = threading.Thread(target=cache.get, args=("slow",))
+    slow.start()
+    try:
+        assert started.wait(5)
+        result = []
+        reader = threading.Thread(target=lambda: result.append(cache.get("cached")))
+        reader.start()
+        reader.join(1)
+        assert result == [b"cached"]
+    finally:
+        release.set()
+        slow.join()
+    assert cache.get("slow") == INIT
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from conftest import SegmentServer, ts_segment
+
+AES = pytest.importorskip("Crypto.Cipher.AES")
+
+KEY = bytes(range(16))
+
+
+def encrypt(index, data):
+    pad = 16 - len(data) % 16
+    return AES.new(KEY, AES.MODE_CBC, index.to_bytes(16, "big")).encrypt(data + bytes([pad]) * pad)
+
+
+# 密钥地址第一次返回 503：重试后拿到密钥，分片正常解密
+def test_key_download_retries_transient_errors(downloader):
+    requests = []
+
+    def key():
+        requests.append(1)
+        return None if len(requests) == 1 else KEY
+
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", '#EXT-X-KEY:METHOD=AES-128,URI="k.bin"']
+    for i in range(4):
+        lines += ["#EXTINF:4.0,", f"s{i}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    files = {f"/s{i}.ts": encrypt(i, ts_segment(i)) for i in range(4)}
+    files["/k.bin"] = key
+    files["/p.m3u8"] = ("\n".join(lines) + "\n").encode()
+    server = SegmentServer(files)
+    try:
+        downloader.retry_base_delay = 0.01
+        downloader.main(server.url + "/p.m3u8", "out.ts", engine="thread")
+    finally:
+        server.close()
+    assert len(requests) == 2
+    with open("out.ts", "rb") as f:
+        assert f.read() == b"".join(ts_segment(i) for i in range(4))
+
+
+# 一个密钥下载卡住时，其他已缓存的密钥照常返回
+def test_slow_key_does_not_block_cached_keys(downloader, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def fetch(uri):
+        started.set()
+        release.wait(5)
+        return KEY
+
+    cache = downloader.KeyCache()
+    cache.keys["cached"] = b"x" * 16
+    monkeypatch.setattr(downloader, "fetch_key", fetch)
+    slow = threading.Thread(target=cache.get, args=("slow",))
+    slow.start()
+    try:
+        assert started.wait(5)
+        result = []
+        reader = threading.Thread(target=lambda: result.append(cache.get("cached")))
+        reader.start()
+        reader.join(1)
+        assert result == [b"x" * 16]
+    finally:
+        release.set()
+        slow.join()
+    assert cache.get("slow") == KEY
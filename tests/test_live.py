@@ -0,0 +1,48 @@
+from conftest import SegmentServer, ts_segment
+
+
+# 每次请求多出现两个分片的直播播放列表，第 2 次刷新返回一次 503，第 4 次刷新带上 EXT-X-ENDLIST
+def live_server(failures):
+    requests = []
+
+    def playlist():
+        requests.append(1)
+        if len(requests) in failures:
+            return None
+        count = min(2 * len(requests), 8)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:1", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for i in range(count):
+            lines += ["#EXTINF:1.0,", f"s{i}.ts"]
+        if count == 8:
+            lines.append("#EXT-X-ENDLIST")
+        return ("\n".join(lines) + "\n").encode()
+
+    files = {f"/s{i}.ts": ts_segment(i) for i in range(8)}
+    files["/live.m3u8"] = playlist
+    return SegmentServer(files)
+
+
+def test_live_reload_retries_transient_errors(downloader):
+    server = live_server(failures={3})
+    try:
+        downloader.retry_base_delay = 0.05
+        downloader.main(server.url + "/live.m3u8", "live.ts", engine="thread", follow=True)
+    finally:
+        server.close()
+    with open("live.ts", "rb") as f:
+        assert f.read() == b"".join(ts_segment(i) for i in range(8))
+
+
+def test_live_reload_gives_up_after_retries(downloader):
+    server = live_server(failures=set(range(2, 100)))
+    try:
+        downloader.retry_attempts = 1
+        downloader.retry_base_delay = 0.05
+        try:
+            downloader.main(server.url + "/live.m3u8", "live.ts", engine="thread", follow=True)
+        except downloader.SegmentError as e:
+            assert "503" in str(e)
+        else:
+            raise AssertionError("刷新一直失败时应该放弃")
+    finally:
+        server.close()
@@ -0,0 +1,86 @@
+import pytest
+
+PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-KEY:METHOD=AES-128,URI="k.bin",IV=0x000102
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="100@0"
+#EXT-X-PROGRAM-DATE-TIME:2024-05-01T10:00:00.000Z
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000@100
+a.ts
+#EXT-X-KEY:METHOD=NONE
+#EXT-X-DISCONTINUITY
+#EXTINF:3.5,
+#EXT-X-BYTERANGE:500
+a.ts
+#EXT-X-CUE-OUT:DURATION=8
+#EXTINF:4.0,
+http://cdn.example/ad.ts
+#EXT-X-CUE-IN
+#EXTINF:4.0,
+../up/b.ts?token=1
+#EXT-X-ENDLIST
+"""
+
+
+def fields(downloader, segment):
+    key, section = segment.key, segment.init_section
+    return (downloader.absolute_uri(segment), segment.duration, segment.byterange, segment.media_sequence,
+            segment.program_date_time, segment.discontinuity, segment.cue_out_start, segment.cue_in,
+            key and (key.method, downloader.absolute_uri(key) if key.uri else None, key.iv),
+            section and (downloader.absolute_uri(section), section.byterange))
+
+
+@pytest.mark.parametrize("uri", ["http://host/dir/p.m3u8", "/tmp/dir/p.m3u8"])
+def test_lean_parser_matches_m3u8_library(downloader, uri):
+    lean = downloader.LeanPlaylist(PLAYLIST, uri)
+    assert lean.supported
+    reference = downloader.m3u8.loads(PLAYLIST, uri=uri)
+    assert [fields(downloader, s) for s in lean.segments] == [fields(downloader, s) for s in reference.segments]
+    assert (lean.is_endlist, lean.target_duration, lean.count) == (True, 4, 4)
+
+
+def test_unknown_tags_fall_back_to_library(downloader):
+    master = "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1\nv.m3u8\n"
+    assert not downloader.LeanPlaylist(master, "http://host/m.m3u8").supported
+    parts = PLAYLIST.replace("#EXT-X-ENDLIST", '#EXT-X-PART:DURATION=1,URI="p.ts"')
+    assert not downloader.LeanPlaylist(parts, "http://host/p.m3u8").supported
+
+
+def test_lazy_tasks_do_not_build_segment_list(downloader, tmp_path, monkeypatch):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:6"]
+    for i in range(1000):
+        lines += ["#EXTINF:6.0,", f"seg/{i:07d}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    path = tmp_path / "big.m3u8"
+    path.write_text("\n".join(lines))
+    # 不剪辑时任务直接从 iter_segments() 生成，不能先建出整个分片列表
+    monkeypatch.setattr(downloader.LeanPlaylist, "segments",
+                        property(lambda self: pytest.fail("lazy 路径生成了完整的分片列表")))
+    sink = downloader.ReorderBuffer("out.ts")
+    tasks = downloader.prepare_tasks(str(path), sink, follow=False, lazy=True)
+    first = next(tasks)
+    assert first.index == 0 and first.url.endswith("seg/0000000.ts")
+    assert sum(1 for _ in tasks) == 999
+    sink.close()
+
+
+GAP_PLAYLIST = """#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXT-X-PROGRAM-DATE-TIME:2024-05-01T00:00:00Z
+""" + "#EXTINF:10.0,\na.ts\n" * 5 + """#EXT-X-DISCONTINUITY
+#EXT-X-PROGRAM-DATE-TIME:2024-05-01T00:05:00Z
+""" + "#EXTINF:10.0,\nb.ts\n" * 5 + "#EXT-X-ENDLIST\n"
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    ("2024-05-01T00:03:00Z", None, (5, 10)),
+    (None, "2024-05-01T00:03:00Z", (0, 5)),
+    ("2024-05-01T00:00:20Z", "2024-05-01T00:05:10Z", (2, 6)),
+])
+def test_clip_times_in_gap_between_anchors(downloader, start, end, expected):
+    segments = downloader.m3u8.loads(GAP_PLAYLIST, uri="http://host/p.m3u8").segments
+    timeline = downloader.SegmentTimeline(segments)
+    assert timeline.span(downloader.parse_clip_time(start), downloader.parse_clip_time(end)) == expected
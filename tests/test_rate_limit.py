@@ -0,0 +1,35 @@
+import json
+import threading
+import time
+
+import pytest
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_lifting_job_limit_reaches_reads_in_flight(downloader, hls_server, tmp_path, engine):
+    # 2 MB 的任务限速 200 KB/s（要 10 秒），1.5 秒时通过限速配置文件取消限速，正在等待的读取也要马上放行
+    server, playlist = hls_server(10)
+    for i in range(10):
+        server.files[f"/s{i}.ts"] *= 50  # 每个分片约 188 KB
+    rate_file = tmp_path / "rate.json"
+    rate_file.write_text(json.dumps({"job": 200000}))
+    downloader.rate_limit_file = str(rate_file)
+    downloader.job_rate_limit = 200000
+    timer = threading.Timer(1.5, lambda: rate_file.write_text(json.dumps({"job": None})))
+    timer.start()
+    started = time.monotonic()
+    downloader.main(playlist, "out.ts", engine=engine)
+    elapsed = time.monotonic() - started
+    timer.cancel()
+    with open("out.ts", "rb") as f:
+        assert len(f.read()) == 10 * 50 * 20 * 188
+    assert elapsed < 4.5
+
+
+def test_bucket_keeps_rate_without_changes(downloader):
+    limiter = downloader.RateLimiter(1_000_000)
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.wait("host", 500_000)
+    # 突发额度 0.5 秒（500 KB），之后每 500 KB 等 0.5 秒
+    assert 0.9 < time.monotonic() - started < 1.5
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from conftest import ts_segment
+
+
+# 默认输出 .mp4 边下载边转封装，不续传，也不产生 ts_files 或暂存文件
+def test_remux_output_streams_without_resume_by_default(downloader, hls_server):
+    _, playlist = hls_server(4)
+    downloader.main(playlist, "out.mp4", engine="thread")
+    assert sorted(os.listdir()) == ["out.mp4"]
+
+
+# 打开 resume_remux 后先写 TS 暂存文件并记日志：第二次运行跳过已按顺序写出的分片，完成后转封装并删掉暂存文件
+@pytest.mark.parametrize("batch", [False, True])
+def test_remux_output_resumes_through_staged_file(downloader, hls_server, batch):
+    downloader.resume_remux = True
+    downloader.retry_attempts = 1
+    downloader.retry_base_delay = 0.01
+    server, playlist = hls_server(6, failing={"/s3.ts"})
+
+    def run():
+        if batch:
+            job = downloader.DownloadJob(playlist, "out.mp4")
+            downloader.BatchScheduler([job]).run("thread")
+            if job.error:
+                raise job.error
+        else:
+            downloader.main(playlist, "out.mp4", engine="thread")
+
+    with pytest.raises(Exception):
+        run()
+    assert os.path.exists("out.mp4.ts") and os.path.exists("out.mp4.journal")
+    server.failing.clear()
+    server.hits.clear()
+    run()
+    assert sorted(hit for hit in server.hits if hit.endswith(".ts")) == ["/s3.ts", "/s4.ts", "/s5.ts"]
+    assert sorted(os.listdir()) == ["out.mp4"]
+    # 合成的分片没有 PAT/PMT，转封装器按原样输出 TS
+    with open("out.mp4", "rb") as f:
+        assert f.read() == b"".join(ts_segment(i) for i in range(6))
+
+
+# 别的视频中断后留在 ts_files 里的分片：没有对应的日志，不能当作续传的前半段，也不能混进合并结果
+def test_stale_ts_files_from_another_video_are_ignored(downloader, hls_server):
+    server, playlist = hls_server(4)
+    os.makedirs(downloader.output_folder)
+    for index in (1, 9):
+        with open(os.path.join(downloader.output_folder, f"test{index:011}.ts"), "wb") as f:
+            f.write(ts_segment(99))
+    downloader.main(playlist, "out.ts", engine="thread", mode="files")
+    with open("out.ts", "rb") as f:
+        assert f.read() == b"".join(ts_segment(i) for i in range(4))
+    assert not server.ranges
+
+
+# 416 的 Content-Range 总长度和已有部分对不上时，丢掉已有部分整段重下
+def test_unsatisfiable_range_with_wrong_total_refetches(downloader, hls_server):
+    server, playlist = hls_server(4)
+    downloader.retry_base_delay = 0.01
+    # 上次下载中断：日志和 ts_files 都属于 out.ts，分片 2 留下了比完整分片还长的数据
+    open("out.ts.journal", "w").close()
+    os.makedirs(downloader.output_folder)
+    with open(os.path.join(downloader.output_folder, ".journal"), "w", encoding="utf-8") as f:
+        f.write(os.path.abspath("out.ts.journal"))
+    with open(os.path.join(downloader.output_folder, f"test{2:011}.ts"), "wb") as f:
+        f.write(ts_segment(99, packets=21))
+    downloader.main(playlist, "out.ts", engine="thread", mode="files")
+    with open("out.ts", "rb") as f:
+        assert f.read() == b"".join(ts_segment(i) for i in range(4))
+    assert server.ranges == [("/s2.ts", f"bytes={21 * 188}-")]
+    assert server.hits.count("/s2.ts") == 2
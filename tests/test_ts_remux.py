@@ -0,0 +1,235 @@
+import io
+import struct
+import threading
+
+import pytest
+
+import ts_remux
+
+VIDEO_PID, AUDIO_PID = 0x100, 0x101
+FRAME_TICKS = 3000  # 30fps
+AUDIO_TICKS = 1024 * 90000 // 48000
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"mvex", b"moof", b"traf"}
+
+
+# 按位写 SPS，最后补 rbsp_stop_one_bit 并插入防竞争字节
+class BitWriter:
+    def __init__(self):
+        self.bits = []
+
+    def u(self, n, value):
+        self.bits += [(value >> (n - 1 - i)) & 1 for i in range(n)]
+
+    def ue(self, value):
+        value += 1
+        self.u(2 * value.bit_length() - 1, value)
+
+    def rbsp(self):
+        bits = self.bits + [1] + [0] * (-(len(self.bits) + 1) % 8)
+        data = bytes(int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+        out, zeros = bytearray(), 0
+        for byte in data:
+            if zeros >= 2 and byte <= 3:
+                out.append(3)
+                zeros = 0
+            out.append(byte)
+            zeros = zeros + 1 if byte == 0 else 0
+        return bytes(out)
+
+
+def make_sps(profile, width_mbs, height_mbs, crop_bottom):
+    w = BitWriter()
+    w.u(8, profile)
+    w.u(16, 40)  # constraint_flags, level_idc
+    w.ue(0)  # seq_parameter_set_id
+    if profile == 100:
+        w.ue(1)  # chroma_format_idc 4:2:0
+        w.ue(0)
+        w.ue(0)
+        w.u(1, 0)
+        w.u(1, 0)  # 没有缩放矩阵
+    w.ue(0)  # log2_max_frame_num_minus4
+    w.ue(2)  # pic_order_cnt_type
+    w.ue(1)  # max_num_ref_frames
+    w.u(1, 0)
+    w.ue(width_mbs - 1)
+    w.ue(height_mbs - 1)
+    w.u(1, 1)  # frame_mbs_only_flag
+    w.u(1, 1)
+    w.u(1, 1 if crop_bottom else 0)
+    if crop_bottom:
+        w.ue(0)
+        w.ue(0)
+        w.ue(0)
+        w.ue(crop_bottom)
+    w.u(1, 0)  # vui_parameters_present_flag
+    return b"\x67" + w.rbsp()
+
+
+SPS = make_sps(100, 120, 68, 4)  # 1920x1080
+PPS = b"\x68\xce\x38\x80"
+
+
+def timestamp(prefix, ts):
+    return bytes((prefix << 4 | (ts >> 29) & 0x0E | 1, ts >> 22 & 0xFF, ts >> 14 & 0xFE | 1,
+                  ts >> 7 & 0xFF, ts << 1 & 0xFE | 1))
+
+
+def pes(stream_id, pts, payload):
+    header = b"\x80\x80\x05" + timestamp(2, pts)
+    length = len(header) + len(payload) if stream_id == 0xC0 else 0
+    return b"\0\0\1" + bytes((stream_id,)) + struct.pack(">H", length) + header + payload
+
+
+# 把一段负载切成 TS 包，最后一个包用适配字段补齐
+def packets(pid, payload, counter):
+    out = []
+    for i in range(0, len(payload), 184):
+        chunk = payload[i:i + 184]
+        start = 0x40 if i == 0 else 0
+        pad = 184 - len(chunk)
+        if pad:
+            adaptation = bytes((pad - 1,)) + (b"\0" + b"\xff" * (pad - 2) if pad > 1 else b"")
+            out.append(bytes((0x47, start | pid >> 8, pid & 0xFF, 0x30 | counter & 0x0F)) + adaptation + chunk)
+        else:
+            out.append(bytes((0x47, start | pid >> 8, pid & 0xFF, 0x10 | counter & 0x0F)) + chunk)
+        counter += 1
+    return b"".join(out)
+
+
+def psi(pid, table_id, body):
+    section = bytes((table_id,)) + struct.pack(">H", 0xB000 | len(body) + 4) + body + bytes(4)
+    return packets(pid, b"\0" + section + b"\xff" * (183 - len(section)), 0)
+
+
+def adts(rate_index, payload):
+    length = 7 + len(payload)
+    return bytes((0xFF, 0xF1, 1 << 6 | rate_index << 2, 2 << 6 | length >> 11, length >> 3 & 0xFF,
+                  (length & 7) << 5 | 0x1F, 0xFC)) + payload
+
+
+# 一个分片：PAT、PMT、frames 帧视频（首帧是带 SPS/PPS 的 IDR）和同样时长的 AAC
+def segment(start, frames=10, rate_index=3):
+    pat = psi(0, 0, struct.pack(">HBBBHH", 1, 0xC1, 0, 0, 1, 0xE000 | 0x1000))
+    pmt = psi(0x1000, 2, struct.pack(">HBBBHH", 1, 0xC1, 0, 0, 0xE000 | VIDEO_PID, 0xF000)
+              + struct.pack(">BHH", 0x1B, 0xE000 | VIDEO_PID, 0xF000)
+              + struct.pack(">BHH", 0x0F, 0xE000 | AUDIO_PID, 0xF000))
+    data = [pat, pmt]
+    for i in range(frames):
+        units = [b"\x09\xf0"] + ([SPS, PPS, b"\x65" + bytes(300)] if i == 0 else [b"\x41" + bytes(100)])
+        data.append(packets(VIDEO_PID, pes(0xE0, start + i * FRAME_TICKS,
+                                           b"".join(b"\0\0\0\1" + unit for unit in units)), i))
+    for i in range(frames * FRAME_TICKS // AUDIO_TICKS):
+        data.append(packets(AUDIO_PID, pes(0xC0, start + i * AUDIO_TICKS, adts(rate_index, bytes(50))), i))
+    return b"".join(data)
+
+
+def boxes(data):
+    i = 0
+    while i < len(data):
+        size, kind = struct.unpack_from(">I4s", data, i)
+        payload = data[i + 8:i + size]
+        yield kind, (list(boxes(payload)) if kind in CONTAINERS else payload)
+        i += size
+
+
+def find(tree, kind):
+    return [payload for name, payload in tree if name == kind]
+
+
+# 每个 moof 里各轨道的 (轨道号, tfdt, 每个采样的时长)
+def fragments(tree):
+    for moof in find(tree, b"moof"):
+        for traf in find(moof, b"traf"):
+            track_id = struct.unpack_from(">I", find(traf, b"tfhd")[0], 4)[0]
+            decode_time = struct.unpack_from(">Q", find(traf, b"tfdt")[0], 4)[0]
+            trun = find(traf, b"trun")[0]
+            flags, count = struct.unpack_from(">II", trun)
+            row = 16 if flags & 0x800 else 8
+            durations = [struct.unpack_from(">I", trun, 12 + k * row)[0] for k in range(count)]
+            yield track_id, decode_time, durations
+
+
+def remux(*parts):
+    out = io.BytesIO()
+    converter = ts_remux.TsToFmp4(out)
+    for part in parts:
+        if part is None:
+            converter.discontinuity()
+        else:
+            converter.write(part)
+    converter.close()
+    return list(boxes(out.getvalue()))
+
+
+def test_box_tree_and_sample_counts():
+    tree = remux(segment(900000), segment(900000 + 10 * FRAME_TICKS))
+    names = [name for name, _ in tree]
+    assert names[:2] == [b"ftyp", b"moov"]
+    assert names[2:] == [b"moof", b"mdat"] * ((len(names) - 2) // 2)
+    moov = tree[1][1]
+    assert [name for name, _ in moov] == [b"mvhd", b"trak", b"trak", b"mvex"]
+    tkhd = find(find(moov, b"trak")[0], b"tkhd")[0]
+    assert struct.unpack_from(">II", tkhd, len(tkhd) - 8) == (1920 << 16, 1080 << 16)
+    counts = {}
+    for track_id, _, durations in fragments(tree):
+        counts[track_id] = counts.get(track_id, 0) + len(durations)
+    assert counts == {1: 20, 2: 2 * (10 * FRAME_TICKS // AUDIO_TICKS)}
+
+
+def test_decode_time_continues_across_discontinuity():
+    tree = remux(segment(900000), None, segment(5000), segment(5000 + 10 * FRAME_TICKS))
+    expected = {}
+    for track_id, decode_time, durations in fragments(tree):
+        assert decode_time == expected.get(track_id, decode_time)
+        expected[track_id] = decode_time + sum(durations)
+    # 时间戳往回跳了，输出时间轴仍然是 30 帧首尾相接
+    assert expected[1] == 30 * FRAME_TICKS
+    assert all(duration == FRAME_TICKS for track_id, _, durations in fragments(tree) if track_id == 1
+               for duration in durations)
+
+
+@pytest.mark.parametrize("profile, width_mbs, height_mbs, crop_bottom, size", [
+    (66, 20, 15, 0, (320, 240)),
+    (100, 120, 68, 4, (1920, 1080)),
+    (100, 80, 45, 0, (1280, 720)),
+])
+def test_parse_sps_dimensions(profile, width_mbs, height_mbs, crop_bottom, size):
+    assert ts_remux.parse_sps(make_sps(profile, width_mbs, height_mbs, crop_bottom)) == size
+
+
+def test_high_sample_rate_audio():
+    tree = remux(segment(0, rate_index=0))  # 96 kHz
+    audio = find(tree[1][1], b"trak")[1]
+    mdhd = find(find(audio, b"mdia")[0], b"mdhd")[0]
+    assert struct.unpack_from(">I", mdhd, 12)[0] == 96000
+
+
+# 转封装在 ReorderBuffer 的写出线程里进行，不占用调用 put 的线程（异步引擎的事件循环）
+def test_reorder_buffer_remuxes_on_writer_thread(downloader, monkeypatch):
+    threads = []
+    write = ts_remux.TsToFmp4.write
+
+    def record(self, data):
+        threads.append(threading.current_thread())
+        write(self, data)
+
+    monkeypatch.setattr(ts_remux.TsToFmp4, "write", record)
+    sink = downloader.ReorderBuffer("out.mp4", remux=True)
+    sink.put(1, segment(900000 + 10 * FRAME_TICKS))
+    sink.put(0, segment(900000))
+    sink.close()
+    assert len(threads) == 2 and threading.current_thread() not in threads
+    with open("out.mp4", "rb") as f:
+        assert list(boxes(f.read())) == remux(segment(900000), segment(900000 + 10 * FRAME_TICKS))
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_download_remuxes_mp4_output(downloader, hls_server, engine):
+    server, playlist = hls_server(4)
+    parts = [segment(900000 + i * 10 * FRAME_TICKS) for i in range(4)]
+    for i, data in enumerate(parts):
+        server.files[f"/s{i}.ts"] = data
+    downloader.main(playlist, "out.mp4", engine=engine)
+    with open("out.mp4", "rb") as f:
+        assert list(boxes(f.read())) == remux(*parts)
@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import SegmentServer
+
+pytest.importorskip("numpy")
+
+
+# 一个带负载的 TS 包；adaptation 为 True 时带自适应字段，discontinuity 设置不连续标记
+def packet(pid, counter, discontinuity=False, adaptation=False):
+    if discontinuity or adaptation:
+        header = bytes((0x47, pid >> 8, pid & 0xFF, 0x30 | counter & 0x0F, 1, 0x80 if discontinuity else 0))
+    else:
+        header = bytes((0x47, pid >> 8, pid & 0xFF, 0x10 | counter & 0x0F))
+    return header + bytes(188 - len(header))
+
+
+def stream(counters, pid=0x100):
+    return b"".join(packet(pid, counter) for counter in counters)
+
+
+@pytest.mark.parametrize("data, problem", [
+    (b"", "空分片"),
+    (stream(range(4))[:-1], "长度 751 不是 188 的整数倍"),
+    (stream(range(2)) + b"\0" + stream([2])[1:], "第 2 个包的同步字节错误"),
+    (stream(range(20)), None),
+    (stream([0, 1, 5, 6]), None),  # 计数器跳变不算校验失败
+], ids=["empty", "length", "sync", "clean", "gap"])
+def test_validate_ts(downloader, data, problem):
+    assert downloader.validate_ts(data) == problem
+
+
+@pytest.mark.parametrize("data, gaps", [
+    (stream(range(40)), 0),  # 计数器回绕
+    (stream([0, 1, 1, 2]), 0),  # 允许重复一次
+    (stream([0, 1, 5, 6, 9]), 2),
+    (stream([0, 1]) + packet(0x100, 7, discontinuity=True) + stream([8]), 0),
+    (stream([0, 1, 2]) + stream([9, 10], pid=0x101) + stream([3]), 0),  # 不同 PID 各自计数
+    (stream([0, 1]) + stream([4, 9], pid=0x1FFF), 0),  # 空包不计
+], ids=["wrap", "duplicate", "gaps", "discontinuity", "pids", "null"])
+def test_continuity_gaps(downloader, data, gaps):
+    assert downloader.continuity_gaps(data) == gaps
+
+
+# 源内容本身有计数器跳变：只下载一次，照常写出，计入指标
+def test_continuity_gap_does_not_fail_download(downloader):
+    segments = [stream(range(8)), stream([0, 1, 2, 9, 10]), stream(range(8))]
+    files = {f"/s{i}.ts": data for i, data in enumerate(segments)}
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:4"] + [f"#EXTINF:4.0,\ns{i}.ts" for i in range(3)]
+    files["/p.m3u8"] = ("\n".join(lines + ["#EXT-X-ENDLIST"]) + "\n").encode()
+    server = SegmentServer(files)
+    try:
+        downloader.main(server.url + "/p.m3u8", "out.ts", engine="thread")
+    finally:
+        server.close()
+    assert server.hits.count("/s1.ts") == 1
+    with open("out.ts", "rb") as f:
+        assert f.read() == b"".join(segments)
+    gaps = {labels: value for (name, labels), value in downloader.metrics.counters.items()
+            if name == "continuity_errors_total"}
+    assert sum(gaps.values()) == 1
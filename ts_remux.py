@@ -0,0 +1,512 @@
+import struct
+
+# 纯 Python 的 MPEG-TS -> 分片 MP4 (fMP4) 转封装，给 m3u8.py 边下载边写 .mp4 用：
+# 解析 PAT/PMT/PES 拿到 H.264 和 AAC(ADTS) 基本流，先写 ftyp + moov，之后每喂入一段 TS 输出一组 moof + mdat，
+# 不需要 ffmpeg，也不需要把整个文件再读一遍
+
+TS_PACKET_SIZE = 188
+
+# 支持的基本流类型（PMT 里的 stream_type）
+STREAM_TYPE_H264 = 0x1B
+STREAM_TYPE_AAC = 0x0F
+
+# 还没拿到所有轨道的编码参数（SPS/PPS、AAC 配置）时最多缓冲这么多字节的输入，
+# 超过后只保留已经就绪的轨道；一个都没有就原样输出 TS
+probe_size = 4 * 1024 * 1024
+
+# 时间戳是 33 位的 90kHz 时钟
+PTS_WRAP = 1 << 33
+# 相邻两帧的解码时间差超出这个范围视为时间戳跳变（不连续点），用上一个正常的帧间隔代替
+max_frame_gap = 90000 * 2
+
+AAC_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+def box(kind, *payloads):
+    payload = b"".join(payloads)
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+def full_box(kind, version, flags, *payloads):
+    return box(kind, struct.pack(">I", (version << 24) | flags), *payloads)
+
+# MPEG-4 描述符（esds 里用），长度都小于 128，用单字节表示
+def descriptor(tag, *payloads):
+    payload = b"".join(payloads)
+    return bytes((tag, len(payload))) + payload
+
+# PES 头里的 33 位时间戳，分散在 5 个字节里
+def read_timestamp(data, i):
+    return (((data[i] >> 1) & 0x07) << 30 | data[i + 1] << 22 | (data[i + 2] >> 1) << 15
+            | data[i + 3] << 7 | data[i + 4] >> 1)
+
+# 按 Annex B 起始码 (00 00 01 / 00 00 00 01) 切出 NAL 单元
+def split_annexb(data):
+    nals = []
+    start = data.find(b"\0\0\1")
+    while start >= 0:
+        start += 3
+        end = data.find(b"\0\0\1", start)
+        # 四字节起始码多出的 0 和 trailing_zero 都属于上一个 NAL 的尾部，去掉
+        nal = (data[start:] if end < 0 else data[start:end]).rstrip(b"\0")
+        if nal:
+            nals.append(nal)
+        start = end
+    return nals
+
+# 按位读取去掉防竞争字节 (00 00 03) 后的 RBSP，用于解析 SPS
+class BitReader:
+    def __init__(self, nal):
+        self.data = nal.replace(b"\0\0\3", b"\0\0")
+        self.pos = 0
+
+    def bits(self, n):
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3] if self.pos >> 3 < len(self.data) else 0
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.bits(1) and zeros < 32:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) >> 1 if value & 1 else -(value >> 1)
+
+# 从 SPS 里算出画面宽高（考虑裁剪和场编码）
+def parse_sps(sps):
+    r = BitReader(sps[1:])
+    profile = r.bits(8)
+    r.bits(16)  # constraint_flags, level_idc
+    r.ue()  # seq_parameter_set_id
+    chroma_format = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = r.ue()
+        if chroma_format == 3:
+            r.bits(1)
+        r.ue()
+        r.ue()
+        r.bits(1)
+        if r.bits(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format != 3 else 12):
+                if r.bits(1):
+                    last = scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if scale:
+                            scale = (last + r.se()) & 0xFF
+                        last = scale or last
+    r.ue()  # log2_max_frame_num_minus4
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()
+    elif poc_type == 1:
+        r.bits(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()  # max_num_ref_frames
+    r.bits(1)
+    width_mbs = r.ue() + 1
+    height_units = r.ue() + 1
+    frame_mbs_only = r.bits(1)
+    if not frame_mbs_only:
+        r.bits(1)
+    r.bits(1)
+    crop = (r.ue(), r.ue(), r.ue(), r.ue()) if r.bits(1) else (0, 0, 0, 0)
+    crop_x = 2 if chroma_format in (1, 2) else 1
+    crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+    width = width_mbs * 16 - (crop[0] + crop[1]) * crop_x
+    height = (2 - frame_mbs_only) * height_units * 16 - (crop[2] + crop[3]) * crop_y
+    return width, height
+
+# 一帧视频或一帧音频；dts/pts 是 90kHz 时钟下展开回绕后的值
+class Sample:
+    __slots__ = ("dts", "pts", "data", "keyframe")
+
+    def __init__(self, dts, pts, data, keyframe):
+        self.dts = dts
+        self.pts = pts
+        self.data = data
+        self.keyframe = keyframe
+
+# 一条输出轨道：收集采样，输出时按自己的时间轴连续排列
+class Track:
+    handler = None
+
+    def __init__(self, track_id):
+        self.id = track_id
+        self.samples = []
+        self.wrap = 0
+        self.last_ts = None
+        self.decode_time = None  # 输出时间轴上下一个采样的解码时间（本轨道的 timescale）
+
+    # 33 位时间戳回绕后继续递增
+    def unwrap(self, ts):
+        ts += self.wrap
+        if self.last_ts is not None and ts < self.last_ts - (PTS_WRAP >> 1):
+            self.wrap += PTS_WRAP
+            ts += PTS_WRAP
+        self.last_ts = ts
+        return ts
+
+    def first_time(self):
+        return self.samples[0].dts if self.samples else None
+
+    # 不连续点之后的时间戳和之前无关，重新开始回绕判断
+    def restart(self):
+        self.wrap = 0
+        self.last_ts = None
+
+class VideoTrack(Track):
+    handler = b"vide"
+    timescale = 90000
+
+    def __init__(self, track_id):
+        super().__init__(track_id)
+        self.sps = None
+        self.pps = None
+        self.width = self.height = 0
+        self.frame_duration = 3000  # 还没有两帧可比较时按 30fps 估计
+
+    @property
+    def ready(self):
+        return self.sps is not None and self.pps is not None
+
+    # 一个 PES 就是一个访问单元：Annex B 转成 4 字节长度前缀；参数集保留在码流里，方便中途切换码率
+    def add(self, pts, dts, payload):
+        units, keyframe = [], False
+        for nal in split_annexb(payload):
+            nal_type = nal[0] & 0x1F
+            if nal_type == 9:  # 访问单元分隔符在 MP4 里没有用
+                continue
+            if nal_type == 7:
+                if self.sps is None:
+                    self.sps = nal
+                    self.width, self.height = parse_sps(nal)
+            elif nal_type == 8:
+                if self.pps is None:
+                    self.pps = nal
+            elif nal_type == 5:
+                keyframe = True
+            units.append(struct.pack(">I", len(nal)))
+            units.append(nal)
+        if not units or pts is None:
+            return
+        # 第一个关键帧之前的帧无法解码，丢掉
+        if not keyframe and not self.samples and self.decode_time is None:
+            return
+        pts = self.unwrap(pts)
+        dts = pts if dts is None else pts - ((pts - dts - self.wrap) % PTS_WRAP)
+        self.samples.append(Sample(dts, pts, b"".join(units), keyframe))
+
+    def sample_entry(self):
+        sps = self.sps
+        avcc = box(b"avcC", bytes((1, sps[1], sps[2], sps[3], 0xFF, 0xE1)),
+                   struct.pack(">H", len(sps)), sps, b"\1", struct.pack(">H", len(self.pps)), self.pps)
+        return box(b"avc1", bytes(6), struct.pack(">H", 1), bytes(16),
+                   struct.pack(">HHIIIH", self.width, self.height, 0x00480000, 0x00480000, 0, 1),
+                   bytes(32), struct.pack(">Hh", 0x18, -1), avcc)
+
+    def media_header(self):
+        return full_box(b"vmhd", 0, 1, bytes(8))
+
+    # 取出可以输出的采样；最后一帧的时长要等下一帧到了才知道，留到下次（final 时按上一帧间隔补上）
+    def take(self, final):
+        samples = self.samples if final else self.samples[:-1]
+        self.samples = [] if final else self.samples[-1:]
+        entries = []
+        for i, sample in enumerate(samples):
+            following = samples[i + 1] if i + 1 < len(samples) else (self.samples[0] if self.samples else None)
+            if following is not None:
+                gap = following.dts - sample.dts
+                if 0 < gap <= max_frame_gap:
+                    self.frame_duration = gap
+            entries.append((sample, self.frame_duration, sample.pts - sample.dts))
+        return entries
+
+class AudioTrack(Track):
+    handler = b"soun"
+    frame_samples = 1024
+
+    def __init__(self, track_id):
+        super().__init__(track_id)
+        self.config = None
+        self.timescale = 0
+        self.channels = 0
+
+    @property
+    def ready(self):
+        return self.config is not None
+
+    # 一个 PES 里可能有多个 ADTS 帧，每帧 1024 个采样，后面的帧按采样率推算时间戳
+    def add(self, pts, dts, payload):
+        if pts is None:
+            return
+        pts = self.unwrap(pts)
+        i, count, size = 0, 0, len(payload)
+        while i + 7 <= size:
+            if payload[i] != 0xFF or payload[i + 1] & 0xF6 != 0xF0:
+                i += 1
+                continue
+            header = 7 if payload[i + 1] & 1 else 9
+            length = (payload[i + 3] & 3) << 11 | payload[i + 4] << 3 | payload[i + 5] >> 5
+            if length < header or i + length > size:
+                break
+            if self.config is None:
+                profile = (payload[i + 2] >> 6) + 1
+                rate_index = (payload[i + 2] >> 2) & 0x0F
+                self.channels = (payload[i + 2] & 1) << 2 | payload[i + 3] >> 6
+                self.timescale = AAC_SAMPLE_RATES[min(rate_index, len(AAC_SAMPLE_RATES) - 1)]
+                self.config = struct.pack(">H", profile << 11 | rate_index << 7 | self.channels << 3)
+            ts = pts + count * self.frame_samples * 90000 // self.timescale
+            self.samples.append(Sample(ts, ts, payload[i + header:i + length], True))
+            count += 1
+            i += length
+
+    def sample_entry(self):
+        esds = full_box(b"esds", 0, 0, descriptor(
+            3, struct.pack(">HB", self.id, 0),
+            descriptor(4, bytes((0x40, 0x15)), bytes(11), descriptor(5, self.config)),
+            descriptor(6, b"\2")))
+        # samplerate 是 16.16 定点数，88.2/96 kHz 放不下时写 0，实际采样率以 esds 里的 AudioSpecificConfig 为准
+        rate = self.timescale << 16 if self.timescale <= 0xFFFF else 0
+        return box(b"mp4a", bytes(6), struct.pack(">H", 1), bytes(8),
+                   struct.pack(">HHHHI", self.channels or 2, 16, 0, 0, rate), esds)
+
+    def media_header(self):
+        return full_box(b"smhd", 0, 0, bytes(4))
+
+    # AAC 每帧时长固定，全部可以直接输出
+    def take(self, final):
+        samples, self.samples = self.samples, []
+        return [(sample, self.frame_samples, 0) for sample in samples]
+
+# TS 解复用：按 PID 拼出 PES，交给对应的轨道
+class TsDemuxer:
+    def __init__(self):
+        self.pmt_pid = None
+        self.tracks = {}  # PID -> Track
+        self.pes = {}  # PID -> 正在拼接的 PES
+        self.ignored = set()
+        self.remainder = b""
+
+    def feed(self, data):
+        if self.remainder:
+            data = self.remainder + data
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        view = memoryview(data)
+        offset = 0
+        while offset < end:
+            if data[offset] != 0x47:
+                # 同步字节错位：找下一个 0x47 重新对齐
+                found = data.find(b"\x47", offset + 1)
+                if found < 0:
+                    offset = len(data)
+                    break
+                offset = found
+                end = offset + (len(data) - offset) // TS_PACKET_SIZE * TS_PACKET_SIZE
+                continue
+            self.packet(data, view, offset)
+            offset += TS_PACKET_SIZE
+        self.remainder = bytes(data[offset:])
+
+    def packet(self, data, view, offset):
+        pid = (data[offset + 1] & 0x1F) << 8 | data[offset + 2]
+        unit_start = data[offset + 1] & 0x40
+        control = data[offset + 3] >> 4 & 3
+        start = offset + 4
+        if control & 2:
+            start += 1 + data[offset + 4]
+        if not control & 1 or start >= offset + TS_PACKET_SIZE:
+            return
+        payload = view[start:offset + TS_PACKET_SIZE]
+        if pid == 0 and unit_start:
+            self.parse_pat(bytes(payload))
+        elif pid == self.pmt_pid and unit_start:
+            self.parse_pmt(bytes(payload))
+        elif pid in self.tracks:
+            if unit_start:
+                self.flush(pid)
+                self.pes[pid] = bytearray(payload)
+            elif pid in self.pes:
+                self.pes[pid] += payload
+
+    # PSI 表都假定在一个 TS 包内（HLS 里的 PAT/PMT 基本都是这样）
+    @staticmethod
+    def section(payload):
+        start = 1 + payload[0]
+        length = (payload[start + 1] & 0x0F) << 8 | payload[start + 2]
+        return payload[start:start + 3 + length - 4]  # 去掉 CRC32
+
+    def parse_pat(self, payload):
+        section = self.section(payload)
+        for i in range(8, len(section) - 3, 4):
+            if section[i] << 8 | section[i + 1]:  # 节目号 0 是网络信息表
+                self.pmt_pid = (section[i + 2] & 0x1F) << 8 | section[i + 3]
+                return
+
+    def parse_pmt(self, payload):
+        section = self.section(payload)
+        i = 12 + ((section[10] & 0x0F) << 8 | section[11])
+        while i + 5 <= len(section):
+            stream_type = section[i]
+            pid = (section[i + 1] & 0x1F) << 8 | section[i + 2]
+            i += 5 + ((section[i + 3] & 0x0F) << 8 | section[i + 4])
+            if pid in self.tracks or pid in self.ignored:
+                continue
+            kind = {STREAM_TYPE_H264: VideoTrack, STREAM_TYPE_AAC: AudioTrack}.get(stream_type)
+            # 同类轨道只取第一条
+            if kind is None or any(isinstance(track, kind) for track in self.tracks.values()):
+                self.ignored.add(pid)
+                print(f"转封装: 忽略不支持的流 PID {pid}（stream_type 0x{stream_type:02X}）")
+                continue
+            self.tracks[pid] = kind(len(self.tracks) + 1)
+
+    def flush(self, pid=None):
+        for pid in ([pid] if pid is not None else list(self.pes)):
+            pes = self.pes.pop(pid, None)
+            if not pes or len(pes) < 9 or pes[:3] != b"\0\0\1":
+                continue
+            flags = pes[7]
+            pts = read_timestamp(pes, 9) if flags & 0x80 else None
+            dts = read_timestamp(pes, 14) if flags & 0xC0 == 0xC0 else None
+            self.tracks[pid].add(pts, dts, bytes(pes[9 + pes[8]:]))
+
+# 转封装器：write() 依次喂入 TS 数据（一般一次一个分片），每次输出一组 moof + mdat；close() 输出剩余的帧
+class TsToFmp4:
+    def __init__(self, out):
+        self.out = out
+        self.demuxer = TsDemuxer()
+        self.tracks = None  # 写出 moov 之后确定的轨道
+        self.probe = []  # 写出 moov 之前缓冲的原始输入，用于退回直接输出 TS
+        self.probed = 0
+        self.passthrough = False
+        self.sequence = 0
+
+    def write(self, data):
+        if not self.passthrough and self.tracks is None and not self.probe and data[:1] != b"\x47":
+            # 输入本身不是 MPEG-TS（例如 fMP4/CMAF 分片），不用转封装
+            self.passthrough = True
+        if self.passthrough:
+            self.out.write(data)
+            return
+        self.demuxer.feed(data)
+        if self.tracks is None:
+            self.probe.append(bytes(data))
+            self.probed += len(data)
+            if not self.start(final=False):
+                return
+        self.fragment(final=False)
+
+    # 不连续点（EXT-X-DISCONTINUITY、去掉广告的地方）：之后喂入的数据换了一条时间轴，
+    # 先把缓冲的帧全部输出（最后一帧按上一帧间隔补时长），输出时间轴接着往后排
+    def discontinuity(self):
+        if self.passthrough:
+            return
+        self.demuxer.flush()
+        self.demuxer.remainder = b""
+        if self.tracks is not None:
+            self.fragment(final=True)
+        for track in self.demuxer.tracks.values():
+            track.restart()
+
+    def close(self):
+        if self.passthrough:
+            return
+        self.demuxer.flush()
+        if self.tracks is None and not self.start(final=True):
+            return
+        self.fragment(final=True)
+
+    # 所有轨道的编码参数都齐了（或者探测数据已经够多）时写出 ftyp + moov
+    def start(self, final):
+        tracks = list(self.demuxer.tracks.values())
+        ready = [track for track in tracks if track.ready]
+        if not ready or (len(ready) < len(tracks) and not final and self.probed < probe_size):
+            if final or self.probed >= probe_size:
+                print("转封装: 没有找到 H.264/AAC 流，按原样输出 TS")
+                self.passthrough = True
+                for data in self.probe:
+                    self.out.write(data)
+                self.probe = None
+            return False
+        self.tracks = ready
+        self.probe = None
+        # 各轨道共用同一个起点，保持音画同步
+        base = min(track.first_time() for track in ready if track.samples) if any(
+            track.samples for track in ready) else 0
+        for track in ready:
+            first = track.first_time()
+            track.decode_time = max(first - base, 0) * track.timescale // 90000 if first is not None else 0
+        self.out.write(self.ftyp() + self.moov())
+        return True
+
+    def ftyp(self):
+        return box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isomiso6avc1mp41")
+
+    def moov(self):
+        mvhd = full_box(b"mvhd", 0, 0, struct.pack(">IIIIIH", 0, 0, 1000, 0, 0x00010000, 0x0100),
+                        bytes(10), MATRIX, bytes(24), struct.pack(">I", len(self.tracks) + 1))
+        traks = [self.trak(track) for track in self.tracks]
+        mvex = box(b"mvex", *(full_box(b"trex", 0, 0, struct.pack(">IIIII", track.id, 1, 0, 0, 0))
+                              for track in self.tracks))
+        return box(b"moov", mvhd, *traks, mvex)
+
+    def trak(self, track):
+        video = isinstance(track, VideoTrack)
+        tkhd = full_box(b"tkhd", 0, 3, struct.pack(">IIIII", 0, 0, track.id, 0, 0), bytes(8),
+                        struct.pack(">hhhH", 0, 0, 0 if video else 0x0100, 0), MATRIX,
+                        struct.pack(">II", (track.width if video else 0) << 16, (track.height if video else 0) << 16))
+        mdhd = full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, track.timescale, 0, 0x55C4, 0))
+        hdlr = full_box(b"hdlr", 0, 0, bytes(4), track.handler, bytes(12),
+                        b"VideoHandler\0" if video else b"SoundHandler\0")
+        dinf = box(b"dinf", full_box(b"dref", 0, 0, struct.pack(">I", 1), full_box(b"url ", 0, 1)))
+        stbl = box(b"stbl",
+                   full_box(b"stsd", 0, 0, struct.pack(">I", 1), track.sample_entry()),
+                   full_box(b"stts", 0, 0, bytes(4)),
+                   full_box(b"stsc", 0, 0, bytes(4)),
+                   full_box(b"stsz", 0, 0, bytes(8)),
+                   full_box(b"stco", 0, 0, bytes(4)))
+        minf = box(b"minf", track.media_header(), dinf, stbl)
+        return box(b"trak", tkhd, box(b"mdia", mdhd, hdlr, minf))
+
+    # 一组 moof + mdat：每条轨道一个 traf，数据按轨道顺序放进同一个 mdat
+    def fragment(self, final):
+        parts = [(track, track.take(final)) for track in self.tracks]
+        parts = [(track, entries) for track, entries in parts if entries]
+        if not parts:
+            return
+        self.sequence += 1
+        # 先按数据偏移 0 算出 moof 大小，再填上真实偏移（偏移字段长度固定，moof 大小不变）
+        moof = self.moof(parts, 0)
+        moof = self.moof(parts, len(moof) + 8)
+        mdat = [sample.data for _, entries in parts for sample, _, _ in entries]
+        self.out.write(moof + struct.pack(">I", 8 + sum(map(len, mdat))) + b"mdat")
+        for data in mdat:
+            self.out.write(data)
+        for track, entries in parts:
+            track.decode_time += sum(duration for _, duration, _ in entries)
+
+    def moof(self, parts, data_offset):
+        trafs = []
+        for track, entries in parts:
+            video = isinstance(track, VideoTrack)
+            rows = []
+            for sample, duration, offset in entries:
+                flags = 0x02000000 if sample.keyframe else 0x01010000
+                rows.append(struct.pack(">IIIi", duration, len(sample.data), flags, offset) if video
+                            else struct.pack(">II", duration, len(sample.data)))
+            trun_flags = 0x000001 | 0x000100 | 0x000200 | (0x000400 | 0x000800 if video else 0)
+            trafs.append(box(b"traf",
+                             full_box(b"tfhd", 0, 0x020000, struct.pack(">I", track.id)),
+                             full_box(b"tfdt", 1, 0, struct.pack(">Q", track.decode_time)),
+                             full_box(b"trun", 1, trun_flags, struct.pack(">Ii", len(entries), data_offset),
+                                      *rows)))
+            data_offset += sum(len(sample.data) for sample, _, _ in entries)
+        return box(b"moof", full_box(b"mfhd", 0, 0, struct.pack(">I", self.sequence)), *trafs)